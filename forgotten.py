@@ -28,10 +28,9 @@
 import signal
 import sys
 import threading
-import time
 
 
-from forgotten.conf import parse_conf, get_logger
+from forgotten.conf import SETTINGS, parse_conf, get_logger
 
 # Setup logging
 logger = get_logger('launcher')
@@ -43,35 +42,56 @@ parse_conf()
 from forgotten.dbops import DB, check_db
 check_db(DB)
 
-# Initialize bot
-from forgotten.bot import bot
+# Initialize bots
+from forgotten.bot import BOTS
 
 # Initialize worker thread
-from forgotten.helper import forgotten_worker
+from forgotten.helper import (
+    SHUTDOWN, backup_worker, forgotten_worker, maintenance_worker,
+    polling_worker, shutdown
+)
 
 WORKER = threading.Thread(target=forgotten_worker, daemon=True)
 WORKER.start()
 
+# Initialize history pruning and vacuum
+MAINTENANCE_WORKER = threading.Thread(target=maintenance_worker, daemon=True)
+MAINTENANCE_WORKER.start()
+
+# Initialize scheduled backups
+if SETTINGS['backup_interval'] > 0:
+    BACKUP_WORKER = threading.Thread(target=backup_worker, daemon=True)
+    BACKUP_WORKER.start()
+
 def sigint_handler(signal, frame):
-    sys.exit(0)
+    logger.info('Shutting down')
+
+    # Stop receiving updates and let the worker drain pending deliveries
+    shutdown(SETTINGS['shutdown_timeout'])
+
+    for bot in BOTS.values():
+        bot.stop_polling()
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGTERM, sigint_handler)
     print('Press Control+C to exit')
 
-    while True:
-        try:
-            logger.info('Start polling')
-            bot.polling(none_stop=True)
+    # One polling thread per bot
+    for bot in BOTS.values():
+        threading.Thread(
+            target=polling_worker,
+            args=(bot,),
+            daemon=True
+        ).start()
 
-        except Exception as e:
-            logger.error(e)
+    while not SHUTDOWN.wait(1):
+        pass
 
-            logger.info('Start sleep')
-            time.sleep(10)
-            logger.info('Ended sleep')
+    # Wait for the worker to flush deliveries and store its snapshot
+    WORKER.join(SETTINGS['shutdown_timeout'] + 5)
 
-            pass
+    if WORKER.is_alive():
+        logger.warning('Worker did not stop in time')
 
-        logger.info('Stop polling')
-bot.stop_polling()
+    sys.exit(0)
@@ -31,27 +31,25 @@ import datetime
 import logging
 import os
 import time
+from functools import partial
 
 import telebot
 from forgotten.conf import SETTINGS
 from forgotten.dbops import DB
-from forgotten import dbops
+from forgotten import dbops, trace
 
 telebot.logger.setLevel(logging.INFO)
 
-# Initialize bot
-bot = telebot.TeleBot(
-    SETTINGS['token'],
-    threaded=True,
-    skip_pending=True
-)
+# Bots by name, initialized at the end of the module
+BOTS = {}
 
-from forgotten.helper import needs_owner, needs_user, is_cancel_cmd
+from forgotten.helper import (
+    WINDOW, needs_admin, needs_owner, needs_user, is_cancel_cmd, make_backup
+)
 
 # Owner commands
 
-@bot.message_handler(commands=['start', 'help'])
-def handle_start(message):
+def handle_start(bot, message):
     """Initialize the bot and show help about commands."""
     response = (
         'Forgotten: reminders on demand\n\n'
@@ -59,6 +57,8 @@ def handle_start(message):
         '/adduser <tg_id> <name> (admin command)\n'
         '/listusers (admin command)\n'
         '/rmuser <tg_id> (admin command)\n'
+        '/backup [media] (admin command)\n'
+        '/stats (admin command)\n'
         '/me -> find Telegram ID\n'
         '/remember -> ask for date and text to remember\n'
         '/remember <datetime> -> ask for text to remember'
@@ -66,14 +66,12 @@ def handle_start(message):
 
     bot.reply_to(message, response)
 
-@bot.message_handler(commands=['me'])
-def me(message):
+def me(bot, message):
     """Return Telegram ID."""
     bot.reply_to(message, message.chat.id)
 
-@bot.message_handler(commands=['adduser'])
 @needs_owner
-def handle_adduser(message):
+def handle_adduser(bot, message):
     """Add a user to the database.
 
     Owner command. Syntax:
@@ -96,7 +94,7 @@ def handle_adduser(message):
 
     # Add user to database
     try:
-        dbops.add_user(DB, int(user_id), name)
+        dbops.add_user(DB, bot.name, int(user_id), name)
 
     except Exception as e:
         bot.reply_to(message, 'Failed to insert user: %s' % e)
@@ -104,9 +102,8 @@ def handle_adduser(message):
 
     bot.reply_to(message, 'New user "%s" created' % name)
 
-@bot.message_handler(commands=['listusers'])
 @needs_owner
-def handle_listusers(message):
+def handle_listusers(bot, message):
     """List users in the database.
 
     Owner command. Syntax:
@@ -114,7 +111,7 @@ def handle_listusers(message):
         /listusers
     """
     to_send = ''
-    for user in dbops.get_users(DB):
+    for user in dbops.get_users(DB, bot.name):
         to_send += '- %d: %s\n' % (user.tg_id, user.name)
 
     if not to_send:
@@ -122,9 +119,8 @@ def handle_listusers(message):
 
     bot.reply_to(message, to_send)
 
-@bot.message_handler(commands=['rmuser'])
 @needs_owner
-def handle_rmuser(message):
+def handle_rmuser(bot, message):
     """Remove user from the database.
 
     Owner command. Syntax:
@@ -140,7 +136,7 @@ def handle_rmuser(message):
 
     # Remove user from database
     try:
-        dbops.remove_user(DB, int(user_id))
+        dbops.remove_user(DB, bot.name, int(user_id))
 
     except Exception as e:
         bot.reply_to(message, 'Failed to remove user: %s' % e)
@@ -148,11 +144,61 @@ def handle_rmuser(message):
 
     bot.reply_to(message, 'User "%s" removed' % user_id)
 
+@needs_admin
+def handle_backup(bot, message):
+    """Create a backup of the database.
+
+    Admin command, as the database is shared by all the bots. Syntax:
+
+        /backup [media]
+
+    If 'media' is provided, stored photos are included in the backup.
+    """
+    arg = telebot.util.extract_arguments(message.text)
+
+    if arg and arg != 'media':
+        bot.reply_to(message, 'Invalid argument: /backup [media]')
+        return
+
+    bot.reply_to(message, 'Creating backup...')
+
+    try:
+        path = make_backup(arg == 'media' or None)
+
+    except Exception as e:
+        bot.reply_to(message, 'Failed to create backup: %s' % e)
+        return
+
+    bot.reply_to(message, 'Backup stored in "%s"' % path)
+
+@needs_admin
+def handle_stats(bot, message):
+    """Show information on the reminders scheduled in memory.
+
+    Admin command, as the window is shared by all the bots. Syntax:
+
+        /stats
+    """
+    stats = WINDOW.stats()
+    horizon = datetime.datetime.fromtimestamp(stats['horizon'])
+
+    response = (
+        'Scheduled reminders: %d\n'
+        'Window until: %s\n'
+        'Memory: %.1f KiB (%.1f bytes per reminder)'
+    ) % (
+        stats['entries'],
+        horizon.strftime('%Y-%m-%d %H:%M'),
+        stats['memory'] / 1024,
+        stats['memory'] / max(stats['entries'], 1)
+    )
+
+    bot.reply_to(message, response)
+
 # User commands
 
-@bot.message_handler(commands=['remember'])
 @needs_user
-def handle_remember(message):
+def handle_remember(bot, message):
     """Create a new reminder.
 
     User command. Syntax:
@@ -181,7 +227,7 @@ def handle_remember(message):
 
         bot.register_next_step_handler(
             reply,
-            lambda m: _remember_content(m, date)
+            partial(_remember_content, bot, date=date)
         )
 
         return
@@ -192,14 +238,14 @@ def handle_remember(message):
         'Specify a date for the reminder in YYYY-MM-DD hh:mm format'
     )
 
-    bot.register_next_step_handler(reply, _remember_date)
+    bot.register_next_step_handler(reply, partial(_remember_date, bot))
 
-def _remember_date(message):
+def _remember_date(bot, message):
     """Ask for the date in which to remember something.
 
     Date must be in YYYY-MM-DD hh:mm format.
     """
-    if not message.text or is_cancel_cmd(message):
+    if not message.text or is_cancel_cmd(bot, message):
         return
 
     try:
@@ -208,7 +254,7 @@ def _remember_date(message):
     except ValueError:
         # Invalid date
         reply = bot.reply_to(message, 'Date must be in format YYYY-MM-DD hh:mm')
-        bot.register_next_step_handler(reply, _remember_date)
+        bot.register_next_step_handler(reply, partial(_remember_date, bot))
         return
 
     # Obtained date, continue with text
@@ -217,9 +263,12 @@ def _remember_date(message):
         'Specify a message or send a photo to remember, or cancel with /cancel'
     )
 
-    bot.register_next_step_handler(reply, lambda m: _remember_content(m, date))
+    bot.register_next_step_handler(
+        reply,
+        partial(_remember_content, bot, date=date)
+    )
 
-def _remember_content(message, date):
+def _remember_content(bot, message, date):
     """Ask for the content to remember.
 
     Content may be a text or photo.
@@ -228,18 +277,24 @@ def _remember_content(message, date):
         reply = bot.reply_to(message, 'Content must be a text or a photo')
         bot.register_next_step_handler(
             reply,
-            lambda m: _remember_content(m, date)
+            partial(_remember_content, bot, date=date)
         )
         return
 
     # Text
     if message.text:
-        if is_cancel_cmd(message):
+        if is_cancel_cmd(bot, message):
             return
 
         # Store reminder
         try:
-            dbops.add_reminder(DB, message.text, date, message.chat.id)
+            rid = dbops.add_reminder(
+                DB,
+                bot.name,
+                message.text,
+                date,
+                message.chat.id
+            )
 
         except Exception as e:
             bot.reply_to(message, 'Failed to store reminder: %s' % e)
@@ -267,8 +322,9 @@ def _remember_content(message, date):
 
         # Store reminder
         try:
-            dbops.add_reminder(
+            rid = dbops.add_reminder(
                 DB,
+                bot.name,
                 '_photo:%s' % store_path,
                 date,
                 message.chat.id
@@ -279,4 +335,54 @@ def _remember_content(message, date):
             os.unlink(store_path)
             return
 
+    # Schedule if within the current window
+    WINDOW.add(time.mktime(date.timetuple()), rid, message.chat.id)
+
     bot.send_message(message.chat.id, 'Reminder stored!')
+
+# Command handlers, in order of registration
+HANDLERS = (
+    (['start', 'help'], handle_start),
+    (['me'], me),
+    (['adduser'], handle_adduser),
+    (['listusers'], handle_listusers),
+    (['rmuser'], handle_rmuser),
+    (['backup'], handle_backup),
+    (['stats'], handle_stats),
+    (['remember'], handle_remember),
+)
+
+def create_bot(name, token, owner):
+    """Create a bot and register the command handlers.
+
+    Handlers receive the bot as their first argument, so that the same
+    functions can serve several bots.
+
+    Args:
+        name (str): Name of the bot, used to separate its users and reminders
+        token (str): Telegram bot token
+        owner (int): Telegram ID of the owner of the bot
+
+    Returns:
+        Bot instance
+    """
+    bot = telebot.TeleBot(token, threaded=True, skip_pending=True)
+    bot.name = name
+    bot.owner = owner
+
+    for commands, handler in HANDLERS:
+        bot.message_handler(commands=commands)(partial(handler, bot))
+
+    if SETTINGS['trace']:
+        trace.install(bot)
+
+    return bot
+
+if SETTINGS['trace']:
+    trace.install_api_hooks()
+
+# Initialize bots
+BOTS.update({
+    name: create_bot(name, conf['token'], conf['owner'])
+    for name, conf in SETTINGS['bots'].items()
+})
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Clocks used by the worker threads."""
+
+import heapq
+import itertools
+import time
+
+
+class SystemClock(object):
+    """Clock backed by the system time."""
+
+    def time(self):
+        """Obtain the current timestamp."""
+        return time.time()
+
+    def sleep(self, seconds):
+        """Block for the given number of seconds."""
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        """Wait until the event is set or the timeout expires.
+
+        Returns:
+            True if the event is set, otherwise False
+        """
+        return event.wait(timeout)
+
+class VirtualClock(object):
+    """Clock that only advances when waited upon.
+
+    Callbacks can be scheduled at given timestamps and are run, in order,
+    as time advances past them. When the end of the simulation is reached,
+    the event passed to `wait()` is set so that workers stop.
+
+    Args:
+        start (float): Initial timestamp
+        end (float): Final timestamp
+    """
+
+    def __init__(self, start, end):
+        self.end = end
+        self._now = start
+        self._agenda = []
+        self._seq = itertools.count()
+
+    def time(self):
+        """Obtain the current timestamp."""
+        return self._now
+
+    def schedule(self, at, callback):
+        """Run a callback when time reaches the given timestamp.
+
+        Args:
+            at (float): Timestamp in which to run the callback
+            callback (callable): Function called without arguments
+        """
+        heapq.heappush(self._agenda, (at, next(self._seq), callback))
+
+    def sleep(self, seconds):
+        """Advance time by the given number of seconds."""
+        self._advance(self._now + seconds)
+
+    def wait(self, event, timeout):
+        """Advance time by the timeout, or up to the end of the simulation.
+
+        Returns:
+            True if the event is set, otherwise False
+        """
+        self._advance(min(self._now + timeout, self.end))
+
+        if self._now >= self.end:
+            event.set()
+
+        return event.is_set()
+
+    def _advance(self, target):
+        """Run callbacks scheduled up to the target and move time there."""
+        while self._agenda and self._agenda[0][0] <= target:
+            at, _, callback = heapq.heappop(self._agenda)
+            self._now = max(self._now, at)
+            callback()
+
+        self._now = max(self._now, target)
@@ -38,6 +38,9 @@ import records
 # Parse configuration file
 SETTINGS = {}
 
+# Name of the bot defined in the [tg] section
+DEFAULT_BOT = 'default'
+
 def parse_conf():
     """Parse the configuration file and set relevant variables.
 
@@ -49,11 +52,41 @@ def parse_conf():
         [tg]
         token = 1234567
         owner = 123
+        rate = 30
 
         [core]
         db_path = /path/to/db.sqlite
         media_path = /path/to/store/media
         wait_time = 15
+        window_time = 180
+        shutdown_timeout = 10
+        snapshot_path = /path/to/db.sqlite.snapshot
+        admin = 123
+
+        [backup]
+        path = /path/to/store/backups
+        interval = 0
+        media = no
+        pages = 64
+        sleep = 5
+
+        [history]
+        retention = 30
+        interval = 60
+        batch = 500
+        vacuum_pages = 64
+        sleep = 5
+
+        [trace]
+        enabled = no
+        threshold = 1000
+        profile_dir = /path/to/store/profiles
+        profile_rate = 0.1
+
+    Several bots can be served by the same process by using one `[tg.<name>]`
+    section per bot instead of the `[tg]` section, which is equivalent to a
+    `[tg.default]` section. The `admin` of the `[core]` section manages the
+    whole process, and defaults to the owner of the default bot.
     """
     conf_path = os.path.abspath(os.getenv('FORGOTTEN_CONF', ''))
 
@@ -65,9 +98,36 @@ def parse_conf():
 
     # settings = {}
 
-    # Telegram bot settings
-    SETTINGS['token'] = parser['tg']['token']
-    SETTINGS['owner'] = int(parser['tg'].get('owner', '-1'))
+    # Telegram bot settings, by bot name
+    SETTINGS['bots'] = {}
+
+    for section in parser.sections():
+        if section == 'tg':
+            name = DEFAULT_BOT
+
+        elif section.startswith('tg.'):
+            name = section[3:]
+
+        else:
+            continue
+
+        if name in SETTINGS['bots']:
+            sys.exit('Bot "%s" is defined more than once' % name)
+
+        token = parser[section]['token']
+
+        if any(bot['token'] == token for bot in SETTINGS['bots'].values()):
+            # Telegram only allows one poller per token
+            sys.exit('Bot "%s" uses the token of another bot' % name)
+
+        SETTINGS['bots'][name] = {
+            'token': token,
+            'owner': int(parser[section].get('owner', '-1')),
+            'rate': float(parser[section].get('rate', '30'))
+        }
+
+    if not SETTINGS['bots']:
+        sys.exit('No bots defined in configuration file')
 
     # Paths
     SETTINGS['db_path'] = parser['core']['db_path']
@@ -75,6 +135,46 @@ def parse_conf():
 
     # Worker
     SETTINGS['wait_time'] = int(parser['core'].get('wait_time', '15')) * 60
+    SETTINGS['window_time'] = int(parser['core'].get('window_time', '180')) * 60
+    SETTINGS['shutdown_timeout'] = int(
+        parser['core'].get('shutdown_timeout', '10')
+    )
+    SETTINGS['snapshot_path'] = parser['core'].get(
+        'snapshot_path',
+        '%s.snapshot' % SETTINGS['db_path']
+    )
+
+    # Administrator of the process, as opposed to the owner of each bot
+    SETTINGS['admin'] = int(parser['core'].get(
+        'admin',
+        str(SETTINGS['bots'].get(DEFAULT_BOT, {}).get('owner', -1))
+    ))
+
+    # Backups (optional section)
+    backup = parser['backup'] if parser.has_section('backup') else {}
+
+    SETTINGS['backup_path'] = backup.get('path', '')
+    SETTINGS['backup_interval'] = int(backup.get('interval', '0')) * 60
+    SETTINGS['backup_media'] = backup.get('media', 'no').lower() in ('yes', 'true', '1')
+    SETTINGS['backup_pages'] = int(backup.get('pages', '64'))
+    SETTINGS['backup_sleep'] = int(backup.get('sleep', '5')) / 1000
+
+    # History of delivered reminders (optional section)
+    history = parser['history'] if parser.has_section('history') else {}
+
+    SETTINGS['history_retention'] = int(history.get('retention', '30')) * 86400
+    SETTINGS['history_interval'] = int(history.get('interval', '60')) * 60
+    SETTINGS['history_batch'] = int(history.get('batch', '500'))
+    SETTINGS['vacuum_pages'] = int(history.get('vacuum_pages', '64'))
+    SETTINGS['history_sleep'] = int(history.get('sleep', '5')) / 1000
+
+    # Tracing of slow updates (optional section)
+    tracing = parser['trace'] if parser.has_section('trace') else {}
+
+    SETTINGS['trace'] = tracing.get('enabled', 'no').lower() in ('yes', 'true', '1')
+    SETTINGS['trace_threshold'] = int(tracing.get('threshold', '1000')) / 1000
+    SETTINGS['trace_profile_dir'] = tracing.get('profile_dir', '')
+    SETTINGS['trace_profile_rate'] = float(tracing.get('profile_rate', '0.1'))
 
 def get_logger(name):
     """Get a logger with the given name."""
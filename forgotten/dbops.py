@@ -27,48 +27,117 @@
 
 """Database operations."""
 
-import datetime
+import sqlite3
 import sys
 import threading
+import time
 from functools import wraps
 
 import records
-from forgotten.conf import SETTINGS, init_db
+from forgotten import trace
+from forgotten.conf import DEFAULT_BOT, SETTINGS, init_db
 
 
 # Lock for operations
 _LOCK = threading.Lock()
 
 # Queries
-ADD_USER = 'INSERT INTO users (tg_id, name) VALUES (:user_id, :name)'
+ADD_USER = (
+    'INSERT INTO users (bot, tg_id, name) '
+    'VALUES (:bot, :user_id, :name)'
+)
+ADD_HISTORY = (
+    'INSERT INTO history '
+    '(reminder_id, bot, user_id, date, delivered_at, outcome) '
+    'VALUES (:reminder_id, :bot, :user_id, :date, :delivered_at, :outcome)'
+)
 ADD_REMINDER = (
-    'INSERT INTO reminders (text, date, user_id) '
-    'VALUES (:text, :date, :user_id)'
+    'INSERT INTO reminders (bot, text, date, user_id) '
+    'VALUES (:bot, :text, :date, :user_id)'
 )
 CREATE_TABLE_USERS = (
     'CREATE TABLE IF NOT EXISTS users ( '
     'id INTEGER PRIMARY KEY, '
-    'tg_id INTEGER UNIQUE, '
-    'name TEXT)'
+    'bot TEXT NOT NULL, '
+    'tg_id INTEGER, '
+    'name TEXT, '
+    'UNIQUE (bot, tg_id))'
 )
 CREATE_TABLE_REMINDERS = (
     'CREATE TABLE IF NOT EXISTS reminders ('
     'id INTEGER PRIMARY KEY, '
+    'bot TEXT NOT NULL, '
     'text TEXT, '
     'date TEXT, '
     'user_id INTEGER, '
-    'FOREIGN KEY (user_id) REFERENCES users (tg_id) ON DELETE CASCADE)'
+    'FOREIGN KEY (bot, user_id) REFERENCES users (bot, tg_id) '
+    'ON DELETE CASCADE)'
+)
+CREATE_TABLE_HISTORY = (
+    'CREATE TABLE IF NOT EXISTS history ('
+    'id INTEGER PRIMARY KEY, '
+    'reminder_id INTEGER, '
+    'bot TEXT, '
+    'user_id INTEGER, '
+    'date TEXT, '
+    'delivered_at TEXT, '
+    'outcome TEXT)'
+)
+CREATE_INDEX_HISTORY_DELIVERED = (
+    'CREATE INDEX IF NOT EXISTS history_delivered ON history (delivered_at)'
+)
+CREATE_INDEX_REMINDERS_DATE = (
+    'CREATE INDEX IF NOT EXISTS reminders_date ON reminders (date)'
 )
+CREATE_INDEX_REMINDERS_USER = (
+    'CREATE INDEX IF NOT EXISTS reminders_user ON reminders (bot, user_id)'
+)
+AUTO_VACUUM_INCREMENTAL = 2
+BEGIN = 'BEGIN'
+DISABLE_FK = 'PRAGMA foreign_keys = OFF'
 ENABLE_FK = 'PRAGMA foreign_keys = ON'
-QUERY_TG_IDS = 'SELECT tg_id FROM users'
-QUERY_REMINDERS = (
-    'SELECT * FROM reminders '
-    "WHERE date < :now"
+ENABLE_INCREMENTAL_VACUUM = 'PRAGMA auto_vacuum = INCREMENTAL'
+INCREMENTAL_VACUUM = 'PRAGMA incremental_vacuum(%d)'
+MIGRATE_SINGLE_BOT = (
+    'ALTER TABLE users RENAME TO users_old',
+    'ALTER TABLE reminders RENAME TO reminders_old',
+    CREATE_TABLE_USERS,
+    CREATE_TABLE_REMINDERS,
+    (
+        'INSERT INTO users (id, bot, tg_id, name) '
+        'SELECT id, :bot, tg_id, name FROM users_old'
+    ),
+    (
+        'INSERT INTO reminders (id, bot, text, date, user_id) '
+        'SELECT id, :bot, text, date, user_id FROM reminders_old'
+    ),
+    'DROP TABLE reminders_old',
+    'DROP TABLE users_old'
+)
+PRUNE_HISTORY = (
+    'DELETE FROM history WHERE id IN ('
+    'SELECT id FROM history WHERE delivered_at < :until '
+    'ORDER BY delivered_at LIMIT :limit)'
 )
-QUERY_USERS = 'SELECT tg_id, name FROM users'
-REMOVE_USER = 'DELETE FROM users WHERE tg_id=:user_id'
-REMOVE_REMINDER = 'DELETE FROM reminders WHERE id=:reminder_id'
-REMOVE_REMINDERS = 'DELETE FROM reminders WHERE id IN :reminder_ids'
+QUERY_AUTO_VACUUM = 'PRAGMA auto_vacuum'
+QUERY_CHANGES = 'SELECT changes() AS count'
+QUERY_FREE_PAGES = 'PRAGMA freelist_count'
+QUERY_LAST_ID = 'SELECT last_insert_rowid() AS id'
+QUERY_LAST_REMINDER_ID = 'SELECT MAX(id) AS id FROM reminders'
+QUERY_TG_IDS = 'SELECT tg_id FROM users WHERE bot=:bot'
+QUERY_USER_COLUMNS = 'PRAGMA table_info(users)'
+QUERY_PHOTOS = "SELECT text FROM reminders WHERE text LIKE '\\_photo:%' ESCAPE '\\'"
+QUERY_REMINDERS_BY_ID = 'SELECT * FROM reminders WHERE id IN (%s)'
+QUERY_USERS = 'SELECT tg_id, name FROM users WHERE bot=:bot'
+QUERY_WINDOW = (
+    'SELECT id, date, user_id FROM reminders '
+    'WHERE date < :until '
+    'AND (date > :date OR (date = :date AND id > :id)) '
+    'ORDER BY date, id LIMIT :limit'
+)
+REMOVE_USER = 'DELETE FROM users WHERE bot=:bot AND tg_id=:user_id'
+REMOVE_REMINDERS = 'DELETE FROM reminders WHERE id IN (%s)'
+VACUUM = 'VACUUM'
 
 # Database connector
 DB = init_db(SETTINGS['db_path'])
@@ -79,99 +148,352 @@ def check_db(db):
     Args:
         db: Database connector
     """
+    # Free pages are reclaimed in the background. Existing files must be
+    # rebuilt once for the setting to take effect
+    auto_vacuum = db.query(QUERY_AUTO_VACUUM).first().auto_vacuum
+
+    if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        db.query(ENABLE_INCREMENTAL_VACUUM)
+        db.query(VACUUM)
+
+    # Databases created before multiple bots were supported
+    columns = [row.name for row in db.query(QUERY_USER_COLUMNS)]
+
+    if columns and 'bot' not in columns:
+        migrate_single_bot(db)
+
     # Enable foreign keys
     db.query(ENABLE_FK)
 
     # Create tables if needed
     db.query(CREATE_TABLE_USERS)
     db.query(CREATE_TABLE_REMINDERS)
+    db.query(CREATE_TABLE_HISTORY)
+    db.query(CREATE_INDEX_REMINDERS_DATE)
+    db.query(CREATE_INDEX_REMINDERS_USER)
+    db.query(CREATE_INDEX_HISTORY_DELIVERED)
+
+def migrate_single_bot(db):
+    """Add the bot name to the tables of a single-bot database.
+
+    Existing users and reminders are assigned to the bot defined in the
+    `[tg]` section of the configuration file. Foreign keys are disabled
+    during the migration so that reminders are not removed along with the
+    old users table. The migration runs in a single transaction, so the
+    database is left untouched if any step fails.
+
+    Args:
+        db: Database connector
+    """
+    # Cannot be changed within a transaction
+    db.query(DISABLE_FK)
+
+    with db.transaction():
+        # The driver does not start transactions for schema changes
+        db.query(BEGIN)
+
+        for query in MIGRATE_SINGLE_BOT:
+            db.query(query, bot=DEFAULT_BOT)
 
 
 def locked(func):
-    """Decorator to use a thread lock to access the database."""
+    """Decorator to use a thread lock to access the database.
+
+    When tracing, the call and the time spent waiting for the lock are
+    recorded as spans. Otherwise, the lock is simply held during the call.
+    """
+    if not SETTINGS.get('trace'):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            with _LOCK:
+                return func(*args, **kwargs)
+
+        return decorated_function
+
+    name = 'dbops.%s' % func.__name__
+
     @wraps(func)
-    def decorated_function(*args, **kwargs):
-        with _LOCK:
-            return func(*args, **kwargs)
+    def traced_function(*args, **kwargs):
+        with trace.span(name):
+            with trace.span('lock wait'):
+                _LOCK.acquire()
+
+            try:
+                return func(*args, **kwargs)
 
-    return decorated_function
+            finally:
+                _LOCK.release()
+
+    return traced_function
 
 @locked
-def add_user(db, user_id, name):
+def add_user(db, bot, user_id, name):
     """Add a new user to the database.
 
     Args:
         db: Database connector
+        bot (str): Name of the bot
         user_id (int): Telegram user ID
         name (str): Name for the user
     """
-    db.query(ADD_USER, user_id=user_id, name=name)
+    db.query(ADD_USER, bot=bot, user_id=user_id, name=name)
 
 @locked
-def get_users(db):
-    """Obtain a list of all users in the database.
+def get_users(db, bot):
+    """Obtain a list of all users of a bot.
 
     Args:
         db: Database connector
+        bot (str): Name of the bot
 
     Returns:
         List of users with Telegram ID and name
     """
-    return db.query(QUERY_USERS)
+    return db.query(QUERY_USERS, bot=bot)
 
 @locked
-def remove_user(db, user_id):
+def remove_user(db, bot, user_id):
     """Remove a user from the database.
 
     Args:
         db: Database connector
+        bot (str): Name of the bot
         user_id (int): Telegram user ID
     """
-    db.query(REMOVE_USER, user_id=user_id)
+    db.query(REMOVE_USER, bot=bot, user_id=user_id)
 
 @locked
-def get_tg_ids(db):
-    """Obtain a list of recognized Telegram user IDs.
+def get_tg_ids(db, bot):
+    """Obtain a list of recognized Telegram user IDs for a bot.
 
     Args:
         db: Database connector
+        bot (str): Name of the bot
 
     Returns:
         Query results for later iteration
     """
-    return db.query(QUERY_TG_IDS)
+    return db.query(QUERY_TG_IDS, bot=bot)
 
 @locked
-def add_reminder(db, text, date, user_id):
+def add_reminder(db, bot, text, date, user_id):
     """Store a new reminder in the database.
 
     Args:
         db: Database connector
+        bot (str): Name of the bot
         text (str): Text to remind
         date (datetime): Date in which to remind the message
         user_id (int): Telegram user ID
+
+    Returns:
+        ID of the new reminder
+    """
+    db.query(ADD_REMINDER, bot=bot, text=text, date=date, user_id=user_id)
+
+    return db.query(QUERY_LAST_ID).first().id
+
+@locked
+def add_reminders(db, reminders):
+    """Store a series of reminders in a single operation.
+
+    Args:
+        db: Database connector
+        reminders (list[dict]): Reminders with `bot`, `text`, `date` and
+            `user_id`
+    """
+    db.bulk_query(ADD_REMINDER, *reminders)
+
+@locked
+def get_last_reminder_id(db):
+    """Obtain the highest reminder ID stored.
+
+    Args:
+        db: Database connector
+
+    Returns:
+        Reminder ID, or 0 if there are no reminders
     """
-    db.query(ADD_REMINDER, text=text, date=date, user_id=user_id)
+    return db.query(QUERY_LAST_REMINDER_ID).first().id or 0
 
 @locked
-def get_active_reminders(db):
-    """Obtain reminders that are ready to be sent.
+def get_upcoming_reminders(db, until, after=None, limit=5000):
+    """Obtain a page of the reminders that are due before the given date.
+
+    Reminders are ordered by date and ID, so that the next page starts
+    after the last reminder of the previous one.
 
     Args:
         db: Database connector
+        until (datetime): Upper limit (exclusive) for the reminder dates
+        after (tuple): Date and ID of the last reminder already obtained
+        limit (int): Maximum number of reminders to obtain
+
+    Returns:
+        List of reminders with ID, date and Telegram user ID
     """
-    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-    return db.query(QUERY_REMINDERS, now=now)
+    until = until.strftime('%Y-%m-%d %H:%M:%S')
+    date, reminder_id = after or ('', 0)
+
+    return db.query(
+        QUERY_WINDOW,
+        until=until,
+        date=date,
+        id=reminder_id,
+        limit=limit
+    ).all()
 
 @locked
-def remove_reminders(db, reminder_ids):
-    """Remove a series of reminders from the database.
+def get_reminders(db, reminder_ids):
+    """Obtain a series of reminders by their ID.
 
     Args:
+        db: Database connector
         reminder_ids (list[int]): List of reminder IDs
+
+    Returns:
+        List of reminders found
     """
-    #TODO bulk delete
-    # db.query(REMOVE_REMINDERS, reminder_ids=reminder_ids)
+    if not reminder_ids:
+        return []
+
+    query, params = _in_query(QUERY_REMINDERS_BY_ID, reminder_ids)
+
+    return db.query(query, **params).all()
+
+@locked
+def archive_reminders(db, entries):
+    """Move delivered reminders to the history.
+
+    Both steps run in a single transaction, so that reminders are never
+    removed without their history entries or archived twice.
+
+    Args:
+        db: Database connector
+        entries (list[dict]): History entries with `reminder_id`, `bot`,
+            `user_id`, `date`, `delivered_at` and `outcome`
+    """
+    if not entries:
+        return
+
+    query, params = _in_query(
+        REMOVE_REMINDERS,
+        [e['reminder_id'] for e in entries]
+    )
+
+    with db.transaction():
+        db.bulk_query(ADD_HISTORY, *entries)
+        db.query(query, **params)
+
+@locked
+def prune_history(db, until, limit):
+    """Remove the oldest history entries delivered before the given date.
+
+    Only up to `limit` entries are removed, so that the lock is not held for
+    long. Callers should repeat until fewer entries are removed.
+
+    Args:
+        db: Database connector
+        until (datetime): Upper limit (exclusive) for the delivery dates
+        limit (int): Maximum number of entries to remove
+
+    Returns:
+        Number of entries removed
+    """
+    until = until.strftime('%Y-%m-%d %H:%M:%S')
+    db.query(PRUNE_HISTORY, until=until, limit=limit)
+
+    return db.query(QUERY_CHANGES).first().count
+
+@locked
+def incremental_vacuum(db, pages):
+    """Return free pages of the database file to the filesystem.
+
+    Args:
+        db: Database connector
+        pages (int): Maximum number of pages to reclaim
+
+    Returns:
+        Number of free pages left in the file
+    """
+    # Each step of the pragma reclaims a single page. The driver only steps
+    # statements without result columns once, except when running scripts
+    _raw_connection(db).executescript('%s;' % (INCREMENTAL_VACUUM % pages))
+
+    return db.query(QUERY_FREE_PAGES).first().freelist_count
+
+def _raw_connection(db):
+    """Obtain the sqlite3 connection used by the database connector."""
+    return db.db.connection.connection
+
+def _in_query(query, values):
+    """Fill the `IN (%s)` clause of a query with a parameter per value.
+
+    Args:
+        query (str): Query with a single `%s` placeholder
+        values (list): Values for the clause
+
+    Returns:
+        Tuple with the query and its parameters
+    """
+    params = {'id%d' % i: value for i, value in enumerate(values)}
+    query = query % ', '.join(':%s' % p for p in params)
+
+    return query, params
+
+def backup_db(db, dest_path, pages=64, sleep=0.005):
+    """Copy the database to a new file while the bot keeps running.
+
+    Uses the SQLite online backup API on the connection of the bot itself, so
+    that writes made during the copy are applied to it instead of restarting
+    it. Each step copies `pages` pages while holding `_LOCK`, which is then
+    released for `sleep` seconds so that regular operations can run.
+
+    Args:
+        db: Database connector
+        dest_path (str): Path in which to write the copy
+        pages (int): Number of pages to copy in each step
+        sleep (float): Seconds to wait between steps
+    """
+    source = _raw_connection(db)
+    dest = sqlite3.connect(dest_path)
+
+    def pause(status, remaining, total):
+        """Release the lock between steps."""
+        _LOCK.release()
+
+        try:
+            time.sleep(sleep)
+
+        finally:
+            _LOCK.acquire()
+
+    _LOCK.acquire()
+
+    try:
+        source.backup(dest, pages=pages, progress=pause)
+
+    finally:
+        _LOCK.release()
+        dest.close()
+
+def get_photo_paths(db_path):
+    """Obtain the paths of the photos referenced by stored reminders.
+
+    Opens its own connection, as it is meant to be used on backup copies.
+
+    Args:
+        db_path (str): Path to the database
+
+    Returns:
+        List of file paths
+    """
+    conn = sqlite3.connect(db_path)
+
+    try:
+        rows = conn.execute(QUERY_PHOTOS).fetchall()
+
+    finally:
+        conn.close()
 
-    for rid in reminder_ids:
-        db.query(REMOVE_REMINDER, reminder_id=rid)
+    return [row[0].replace('_photo:', '', 1) for row in rows]
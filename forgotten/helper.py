@@ -27,94 +27,603 @@
 
 """Helper functions."""
 
+import datetime
 import os
-import time
+import tarfile
+import threading
+from collections import OrderedDict, deque
 from functools import wraps
 
-import telebot
-from forgotten import dbops
-from forgotten.bot import bot
+from forgotten import dbops, trace
+from forgotten.clock import SystemClock
 from forgotten.conf import SETTINGS, get_logger
 from forgotten.dbops import DB
+from forgotten.schedule import RateLimiter, Window, to_epoch
 
 
 logger = get_logger('helper')
 
 
-def forgotten_worker():
-    """Thread worker that continuously checks for active reminders."""
+# Set when the bot is shutting down
+SHUTDOWN = threading.Event()
+
+# Upcoming reminders
+WINDOW = Window()
+
+# Default clock for the workers
+CLOCK = SystemClock()
+
+# Rate limiters, by bot token
+LIMITERS = {}
+
+# Maximum number of reminders fetched from the database at once
+DELIVERY_BATCH = 500
+
+# Reminders read from the database per lock acquisition when refilling
+REFILL_BATCH = 5000
+
+_deadline = None
+
+# History entries of sent reminders that could not be removed yet
+_unarchived = []
+
+
+def forgotten_worker(clock=CLOCK, senders=None):
+    """Thread worker that continuously checks for active reminders.
+
+    A single worker sends the reminders of all the bots. Reminders due within
+    the configured window are kept in memory, and the database is only
+    queried for them again when the window expires. On shutdown, pending
+    deliveries are drained until the shutdown deadline and the window is
+    stored in a snapshot for the next start.
+
+    Args:
+        clock: Clock used to obtain the time and wait between checks
+        senders (dict): Objects used to send reminders, by bot name.
+            Defaults to the configured bots
+    """
+    senders = senders or _get_bots()
     wait_time = SETTINGS['wait_time']
     logger.info('starting worker thread with a waiting time of %d' % wait_time)
 
-    while True:
-        reminders = dbops.get_active_reminders(DB)
+    if WINDOW.load_snapshot(
+            SETTINGS['snapshot_path'],
+            SETTINGS['db_path'],
+            clock.time(),
+            dbops.get_last_reminder_id(DB)):
+        logger.info('resumed %d reminders from snapshot' % len(WINDOW))
+
+    while not SHUTDOWN.is_set():
+        now = clock.time()
+
+        try:
+            if now >= WINDOW.horizon:
+                refill_window(now)
+
+            deliver_reminders(now, clock, senders)
+
+        except Exception as e:
+            # Retried in the next check
+            logger.error('failed to deliver reminders: %s' % e)
+
+        clock.wait(SHUTDOWN, wait_time)
+
+    # Drain reminders that became due while waiting
+    try:
+        deliver_reminders(clock.time(), clock, senders)
+
+    except Exception as e:
+        logger.error('failed to deliver reminders: %s' % e)
 
-        # Send reminders that are ready
-        to_delete = []
+    try:
+        WINDOW.save_snapshot(SETTINGS['snapshot_path'], SETTINGS['db_path'])
 
-        for reminder in reminders:
-            to_delete.append(reminder.id)
+    except Exception as e:
+        logger.error('failed to store snapshot: %s' % e)
 
-            if reminder.text.startswith('_photo:'):
-                # Must send photo
-                file_path = reminder.text.replace('_photo:', '')
+    logger.info('stopped worker thread')
 
-                if not os.path.exists(file_path):
-                    bot.send_message(reminder.user_id, 'Cannot find photo')
+def polling_worker(bot):
+    """Thread worker that receives updates for a bot until shutdown.
+
+    Args:
+        bot: Bot to poll
+    """
+    while not SHUTDOWN.is_set():
+        try:
+            logger.info('start polling %s' % bot.name)
+            bot.polling(none_stop=True)
+
+        except Exception as e:
+            logger.error(e)
+
+            logger.info('start sleep')
+            SHUTDOWN.wait(10)
+            logger.info('ended sleep')
+
+        logger.info('stop polling %s' % bot.name)
+
+def refill_window(now):
+    """Load reminders due within the configured window from the database.
+
+    Args:
+        now (float): Current timestamp
+    """
+    horizon = now + SETTINGS['window_time']
+
+    WINDOW.start_load()
+
+    try:
+        # Reminders stored from now on are added to the window while loading
+        last_id = dbops.get_last_reminder_id(DB)
+
+        WINDOW.load(
+            _upcoming_entries(datetime.datetime.fromtimestamp(horizon)),
+            horizon,
+            last_id
+        )
+
+    except Exception:
+        WINDOW.abort_load()
+        raise
+
+    stats = WINDOW.stats()
+    logger.debug(
+        'loaded %d reminders in window (%d bytes)'
+        % (stats['entries'], stats['memory'])
+    )
+
+def deliver_reminders(now, clock=CLOCK, senders=None):
+    """Send the reminders in the window that are ready.
+
+    Reminders of different bots are interleaved, and each bot is limited to
+    its configured rate. The worker only waits when all the bots with pending
+    reminders are over their limit.
+
+    Delivered reminders are removed from the database after each batch. If
+    that fails, they are kept in memory and not sent again until they are
+    removed in a later call. If the shutdown deadline is reached, remaining
+    reminders are returned to the window and kept for the next start.
+
+    Args:
+        now (float): Current timestamp
+        clock: Clock used for rate limits and the shutdown deadline
+        senders (dict): Objects used to send reminders, by bot name.
+            Defaults to the configured bots
+    """
+    senders = senders or _get_bots()
+
+    # Sent in a previous call but not removed yet
+    _archive([])
+
+    due = WINDOW.pop_due(now)
+
+    for start in range(0, len(due), DELIVERY_BATCH):
+        batch = due[start:start + DELIVERY_BATCH]
+        archiving = {e['reminder_id'] for e in _unarchived}
+
+        try:
+            reminders = {
+                r.id: r
+                for r in dbops.get_reminders(DB, [e[1] for e in batch])
+                if r.id not in archiving
+            }
+
+        except Exception:
+            WINDOW.push_back(due[start:])
+            raise
+
+        # Group by bot, keeping the order of each
+        queues = OrderedDict()
+
+        for entry in batch:
+            # Popped so that an ID is never sent twice in a batch
+            reminder = reminders.pop(entry[1], None)
+
+            if reminder is None:
+                # Removed in the meantime
+                continue
+
+            if reminder.bot not in senders:
+                logger.warning(
+                    'reminder %d belongs to unknown bot %s'
+                    % (reminder.id, reminder.bot)
+                )
+                continue
+
+            queues.setdefault(reminder.bot, deque()).append((entry, reminder))
+
+        delivered = []
+
+        try:
+            while queues:
+                if _deadline_reached(clock):
+                    pending = [e for q in queues.values() for e, _ in q]
+                    WINDOW.push_back(pending + due[start + DELIVERY_BATCH:])
+                    logger.warning(
+                        'shutdown deadline reached, %d reminders pending'
+                        % (len(pending) + len(due) - start - len(batch))
+                    )
                     return
 
-                # Send file
-                with open(file_path, 'rb') as photo:
-                    bot.send_photo(reminder.user_id, photo)
+                delays = []
+
+                for name in list(queues):
+                    limiter = _get_limiter(name)
+                    delay = limiter.delay(clock.time())
+
+                    if delay > 0:
+                        delays.append(delay)
+                        continue
+
+                    _, reminder = queues[name].popleft()
+
+                    if not queues[name]:
+                        del queues[name]
+
+                    limiter.consume(clock.time())
+                    outcome = send_reminder(reminder, senders[name])
+
+                    if outcome == 'retry':
+                        # Kept in the database and retried when the window
+                        # is loaded again
+                        continue
+
+                    delivered.append({
+                        'reminder_id': reminder.id,
+                        'bot': reminder.bot,
+                        'user_id': reminder.user_id,
+                        'date': reminder.date,
+                        'delivered_at': _format_time(clock.time()),
+                        'outcome': outcome
+                    })
+
+                if len(delays) == len(queues) and delays:
+                    # All bots are over their limit
+                    clock.sleep(min(delays))
+
+        finally:
+            # Move sent reminders to the history
+            _archive(delivered)
+
+def send_reminder(reminder, sender):
+    """Send a reminder to its user.
+
+    Errors are logged and not raised, so that a failed reminder does not
+    stop the rest. Reminders rejected by Telegram are given up, and their
+    photo is removed. Other errors (e.g. network errors) are temporary, and
+    the reminder is kept so that it can be retried later.
+
+    Args:
+        reminder: Reminder record
+        sender: Object used to send the reminder
+
+    Returns:
+        Outcome of the delivery: 'sent', 'missing_photo', 'failed' or 'retry'
+    """
+    file_path = None
+
+    try:
+        if reminder.text.startswith('_photo:'):
+            # Must send photo
+            file_path = reminder.text.replace('_photo:', '')
+
+            if not os.path.exists(file_path):
+                sender.send_message(reminder.user_id, 'Cannot find photo')
+                return 'missing_photo'
+
+            # Send file
+            with open(file_path, 'rb') as photo:
+                sender.send_photo(reminder.user_id, photo)
+
+            # Remove file
+            os.unlink(file_path)
+
+            return 'sent'
+
+        # Send text
+        sender.send_message(reminder.user_id, reminder.text)
+
+    except Exception as e:
+        logger.error('failed to send reminder %d: %s' % (reminder.id, e))
+
+        if not _is_permanent(e):
+            return 'retry'
+
+        if file_path and os.path.exists(file_path):
+            os.unlink(file_path)
+
+        return 'failed'
+
+    return 'sent'
 
-                # Remove file
-                os.unlink(file_path)
+def maintenance_worker(clock=CLOCK):
+    """Thread worker that prunes the history and reclaims free pages.
 
+    Both tasks run in small batches, each of them holding the database lock
+    only briefly, so that deliveries are not delayed.
+
+    Args:
+        clock: Clock used to obtain the time and wait between runs
+    """
+    interval = SETTINGS['history_interval']
+    logger.info('starting maintenance thread with an interval of %d' % interval)
+
+    while not clock.wait(SHUTDOWN, interval):
+        try:
+            pruned = prune_history(clock)
+            free_pages = vacuum_db(clock)
+
+        except Exception as e:
+            logger.error('maintenance failed: %s' % e)
+            continue
+
+        logger.debug(
+            'pruned %d history entries, %d free pages left'
+            % (pruned, free_pages)
+        )
+
+def prune_history(clock=CLOCK):
+    """Remove history entries older than the retention period.
+
+    Returns:
+        Number of entries removed
+    """
+    if not SETTINGS['history_retention']:
+        return 0
+
+    until = datetime.datetime.fromtimestamp(
+        clock.time() - SETTINGS['history_retention']
+    )
+    batch = SETTINGS['history_batch']
+    total = 0
+
+    while not SHUTDOWN.is_set():
+        removed = dbops.prune_history(DB, until, batch)
+        total += removed
+
+        if removed < batch:
+            break
+
+        # The lock is not fair, so give other operations time to take it
+        clock.sleep(SETTINGS['history_sleep'])
+
+    return total
+
+def vacuum_db(clock=CLOCK):
+    """Reclaim the free pages of the database file a few at a time.
+
+    Returns:
+        Number of free pages left
+    """
+    pages = SETTINGS['vacuum_pages']
+    free_pages = dbops.incremental_vacuum(DB, pages)
+
+    while free_pages and not SHUTDOWN.is_set():
+        clock.sleep(SETTINGS['history_sleep'])
+        free_pages = dbops.incremental_vacuum(DB, pages)
+
+    return free_pages
+
+def shutdown(timeout, clock=CLOCK):
+    """Signal worker threads to stop.
+
+    Args:
+        timeout (int): Seconds allowed for pending deliveries
+        clock: Clock used by the workers
+    """
+    global _deadline
+
+    _deadline = clock.time() + timeout
+    SHUTDOWN.set()
+
+def _format_time(timestamp):
+    """Format a timestamp as stored in the database."""
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M:%S'
+    )
+
+def _is_permanent(error):
+    """Check whether a Bot API error would happen again if retried.
+
+    Telegram rejects requests it will never accept (e.g. a user that blocked
+    the bot) with a 4xx status other than 429 (too many requests).
+    """
+    result = getattr(error, 'result', None)
+    status = getattr(result, 'status_code', None)
+
+    return status is not None and 400 <= status < 500 and status != 429
+
+def _get_bots():
+    """Obtain the configured bots.
+
+    Imported on demand, so that the worker can run without Telegram (e.g.
+    in simulations).
+    """
+    from forgotten.bot import BOTS
+
+    return BOTS
+
+def _get_limiter(name):
+    """Obtain the rate limiter for the token of the given bot."""
+    conf = SETTINGS['bots'][name]
+
+    if conf['token'] not in LIMITERS:
+        LIMITERS[conf['token']] = RateLimiter(conf['rate'])
+
+    return LIMITERS[conf['token']]
+
+def _archive(entries):
+    """Move sent reminders to the history, keeping them if it fails.
+
+    Args:
+        entries (list[dict]): History entries of the reminders
+    """
+    _unarchived.extend(entries)
+
+    if not _unarchived:
+        return
+
+    try:
+        dbops.archive_reminders(DB, _unarchived)
+
+    except Exception as e:
+        logger.error(
+            'failed to archive %d reminders: %s' % (len(_unarchived), e)
+        )
+        return
+
+    del _unarchived[:]
+
+def _deadline_reached(clock):
+    """Check whether the shutdown deadline has passed."""
+    return _deadline is not None and clock.time() > _deadline
+
+def _upcoming_entries(until):
+    """Read the window entries due before the given date, page by page."""
+    after = None
+
+    while True:
+        reminders = dbops.get_upcoming_reminders(
+            DB, until, after=after, limit=REFILL_BATCH
+        )
+
+        for r in reminders:
+            yield (to_epoch(r.date), r.id, r.user_id)
+
+        if len(reminders) < REFILL_BATCH:
+            return
+
+        after = (reminders[-1].date, reminders[-1].id)
+
+def backup_worker():
+    """Thread worker that periodically creates a backup of the database."""
+    interval = SETTINGS['backup_interval']
+    logger.info('starting backup thread with an interval of %d' % interval)
+
+    while not SHUTDOWN.wait(interval):
+        try:
+            path = make_backup()
+
+        except Exception as e:
+            logger.error('backup failed: %s' % e)
+            continue
+
+        logger.info('created backup %s' % path)
+
+def make_backup(with_media=None):
+    """Create a backup of the database in the configured backup path.
+
+    The database is copied in small steps so that the bot can keep working
+    in the meantime. If media files are included, the copy and the photos it
+    references are bundled into a tarball and the plain copy is removed.
+
+    Args:
+        with_media (bool): Whether to include media files. Defaults to the
+            `media` setting of the configuration file
+
+    Returns:
+        Path to the created backup
+    """
+    if with_media is None:
+        with_media = SETTINGS['backup_media']
+
+    backup_dir = SETTINGS['backup_path'] or os.path.dirname(
+        os.path.abspath(SETTINGS['db_path'])
+    )
+    os.makedirs(backup_dir, exist_ok=True)
+
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    db_copy = os.path.join(backup_dir, 'forgotten-%s.sqlite' % stamp)
+
+    dbops.backup_db(
+        DB,
+        db_copy,
+        pages=SETTINGS['backup_pages'],
+        sleep=SETTINGS['backup_sleep']
+    )
+
+    if not with_media:
+        return db_copy
+
+    # Bundle database copy and referenced photos
+    tar_path = os.path.join(backup_dir, 'forgotten-%s.tar.gz' % stamp)
+
+    with tarfile.open(tar_path, 'w:gz') as tar:
+        tar.add(db_copy, arcname=os.path.basename(db_copy))
+
+        for file_path in dbops.get_photo_paths(db_copy):
+            if not os.path.exists(file_path):
+                logger.warning('missing photo %s' % file_path)
                 continue
 
-            # Send text
-            bot.send_message(reminder.user_id, reminder.text)
+            tar.add(
+                file_path,
+                arcname=os.path.join('media', os.path.basename(file_path))
+            )
 
-        # Remove old reminders
-        if to_delete:
-            dbops.remove_reminders(DB, to_delete)
+    os.unlink(db_copy)
 
-        time.sleep(wait_time)
+    return tar_path
+
+def needs_admin(func):
+    """Decorator to require the administrator of the process.
+
+    Used for commands that affect every bot, as the owner of a bot only
+    manages that bot.
+    """
+    @wraps(func)
+    def decorated_function(bot, message, *args, **kwargs):
+        if message.chat.id != SETTINGS['admin']:
+            bot.reply_to(message, 'Sorry, you are not the admin of this bot')
+            return
+
+        return func(bot, message, *args, **kwargs)
+
+    return decorated_function
 
 def needs_owner(func):
-    """Decorator to require the owner for the given function."""
+    """Decorator to require the owner of the bot for the given function."""
     @wraps(func)
-    def decorated_function(*args, **kwargs):
-        if args[0].chat.id != SETTINGS['owner']:
-            bot.reply_to(args[0], 'Sorry, you are not the owner of this bot')
+    def decorated_function(bot, message, *args, **kwargs):
+        if message.chat.id != bot.owner:
+            bot.reply_to(message, 'Sorry, you are not the owner of this bot')
             return
 
-        return func(*args, **kwargs)
+        return func(bot, message, *args, **kwargs)
 
     return decorated_function
 
 def needs_user(func):
-    """Decorator to require a user for the given function."""
+    """Decorator to require a user of the bot for the given function."""
     @wraps(func)
-    def decorated_function(*args, **kwargs):
-        for row in dbops.get_tg_ids(DB):
-            if row.tg_id == args[0].chat.id:
-                return func(*args, **kwargs)
+    def decorated_function(bot, message, *args, **kwargs):
+        with trace.span('needs_user'):
+            is_user = any(
+                row.tg_id == message.chat.id
+                for row in dbops.get_tg_ids(DB, bot.name)
+            )
 
-        bot.reply_to(args[0], "Sorry, I don't recognize you. Contact the admin")
+        if is_user:
+            return func(bot, message, *args, **kwargs)
+
+        bot.reply_to(message, "Sorry, I don't recognize you. Contact the admin")
 
     return decorated_function
 
-def is_cancel_cmd(message):
+def is_cancel_cmd(bot, message):
     """Check whether the message is a '/cancel' command.
 
     Args:
+        bot: Bot that received the message.
         message: Received Telegram message.
 
     Returns:
         True if it is a '/cancel' message, otherwise False.
     """
-    cmd = telebot.util.extract_command(message.text)
+    from telebot.util import extract_command
+
+    cmd = extract_command(message.text)
     if cmd and cmd == 'cancel':
         bot.reply_to(message, 'Operation cancelled')
 
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""In-memory scheduling of upcoming reminders."""
+
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from operator import itemgetter
+
+
+def to_epoch(date):
+    """Convert a stored reminder date to a timestamp.
+
+    Args:
+        date (str): Date in YYYY-MM-DD hh:mm[:ss] format
+
+    Returns:
+        Local timestamp in seconds
+    """
+    parsed = datetime.datetime.strptime(date[:16], '%Y-%m-%d %H:%M')
+    return time.mktime(parsed.timetuple())
+
+class Window(object):
+    """Reminders that are due before a given horizon.
+
+    Entries are stored in parallel arrays of dates, reminder IDs and user IDs
+    sorted by date, which takes 24 bytes per reminder. The text of each
+    reminder is not kept in memory and must be fetched by ID on delivery.
+    Entries are exchanged as `(epoch, reminder_id, user_id)` tuples.
+
+    The highest reminder ID known to the window is tracked as well, so that
+    reminders stored without being added to the window can be detected.
+    """
+
+    def __init__(self):
+        self.horizon = 0
+        self.last_id = 0
+        self._epochs = array('d')
+        self._ids = array('q')
+        self._users = array('q')
+        self._head = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._epochs) - self._head
+
+    def start_load(self):
+        """Start collecting new entries while the window is being reloaded.
+
+        Entries added between this call and `load()` are merged into the
+        new window so that they are not lost.
+        """
+        with self._lock:
+            self._pending = []
+
+    def load(self, entries, horizon, last_id=0):
+        """Replace the contents of the window.
+
+        Entries are appended to the new arrays as they are read, so they
+        should be ordered by date. Entries added since `start_load()` are
+        merged afterwards.
+
+        Args:
+            entries (iterable): Entries due before the horizon
+            horizon (float): Timestamp until which the window is complete
+            last_id (int): Highest reminder ID stored when the load started
+        """
+        epochs, ids, users = array('d'), array('q'), array('q')
+        ordered = True
+        last = float('-inf')
+
+        for epoch, reminder_id, user_id in entries:
+            # Dates skipped by DST changes may not map to increasing times
+            ordered = ordered and epoch >= last
+            last = epoch
+
+            epochs.append(epoch)
+            ids.append(reminder_id)
+            users.append(user_id)
+
+        if not ordered:
+            order = sorted(range(len(epochs)), key=epochs.__getitem__)
+            epochs = array('d', (epochs[i] for i in order))
+            ids = array('q', (ids[i] for i in order))
+            users = array('q', (users[i] for i in order))
+
+        with self._lock:
+            self._epochs, self._ids, self._users = epochs, ids, users
+            self._head = 0
+
+            # Entries added while loading may also come from the database
+            pending = [e for e in self._pending or () if e[0] < horizon]
+            self._pending = None
+            self.horizon = horizon
+            self.last_id = max(self.last_id, last_id)
+
+            self._place(pending)
+
+    def abort_load(self):
+        """Stop collecting new entries after a failed reload.
+
+        The current contents are kept, and entries added in the meantime
+        are placed in the window if they fall within it.
+        """
+        with self._lock:
+            pending = [e for e in self._pending or () if e[0] < self.horizon]
+            self._pending = None
+
+            self._place(pending)
+
+    def add(self, epoch, reminder_id, user_id):
+        """Add a new reminder if it falls within the window.
+
+        Reminders already in the window (e.g. loaded from the database
+        before this call) are ignored.
+
+        Args:
+            epoch (float): Timestamp in which to send the reminder
+            reminder_id (int): Reminder ID
+            user_id (int): Telegram user ID
+        """
+        with self._lock:
+            self.last_id = max(self.last_id, reminder_id)
+
+            if self._pending is not None:
+                self._pending.append((epoch, reminder_id, user_id))
+
+            elif epoch < self.horizon:
+                if not self._contains(epoch, reminder_id):
+                    self._insert(epoch, reminder_id, user_id)
+
+    def pop_due(self, now):
+        """Remove and return the entries that are ready to be sent.
+
+        Args:
+            now (float): Current timestamp
+
+        Returns:
+            List of entries ordered by date
+        """
+        with self._lock:
+            end = bisect_right(self._epochs, now, self._head)
+            due = list(zip(
+                self._epochs[self._head:end],
+                self._ids[self._head:end],
+                self._users[self._head:end]
+            ))
+
+            self._head = end
+
+            # Drop sent entries once they take most of the arrays
+            if self._head > len(self._epochs) // 2:
+                del self._epochs[:self._head]
+                del self._ids[:self._head]
+                del self._users[:self._head]
+                self._head = 0
+
+        return due
+
+    def push_back(self, entries):
+        """Return entries that could not be sent to the window.
+
+        Entries that were loaded again in the meantime are ignored. As they
+        usually precede every other entry, they are placed before the head of
+        the window in one go; otherwise the window is rebuilt merging both.
+
+        Args:
+            entries (iterable): Entries returned by `pop_due()`
+        """
+        with self._lock:
+            self._place(entries)
+
+    def stats(self):
+        """Obtain the size of the window.
+
+        Returns:
+            Dictionary with the number of entries, the memory used by the
+            arrays (in bytes) and the horizon
+        """
+        with self._lock:
+            size = sum(
+                sys.getsizeof(a) for a in (self._epochs, self._ids, self._users)
+            )
+
+            return {
+                'entries': len(self._epochs) - self._head,
+                'memory': size,
+                'horizon': self.horizon
+            }
+
+    def save_snapshot(self, path, db_path):
+        """Store the window in a file so that it can be resumed later.
+
+        The file contains a JSON header line followed by the raw contents of
+        the arrays. The modification time of the database and the highest
+        reminder ID known to the window are stored as well, so that the
+        snapshot is discarded if the database changes in the meantime or a
+        reminder was stored without reaching the window.
+
+        Args:
+            path (str): Path to the snapshot file
+            db_path (str): Path to the database
+        """
+        tmp_path = '%s.tmp' % path
+
+        with self._lock, open(tmp_path, 'wb') as snapshot_file:
+            header = {
+                'horizon': self.horizon,
+                'last_id': self.last_id,
+                'db_mtime': os.path.getmtime(db_path),
+                'count': len(self._epochs) - self._head
+            }
+
+            snapshot_file.write(json.dumps(header).encode('utf-8') + b'\n')
+
+            for column in (self._epochs, self._ids, self._users):
+                column[self._head:].tofile(snapshot_file)
+
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path, db_path, now, last_id):
+        """Resume the window from a snapshot file.
+
+        The snapshot is removed after reading it, as it is only valid for the
+        first start after it was written.
+
+        Args:
+            path (str): Path to the snapshot file
+            db_path (str): Path to the database
+            now (float): Current timestamp
+            last_id (int): Highest reminder ID in the database
+
+        Returns:
+            True if the snapshot was loaded, otherwise False
+        """
+        if not os.path.isfile(path):
+            return False
+
+        columns = (array('d'), array('q'), array('q'))
+
+        try:
+            with open(path, 'rb') as snapshot_file:
+                header = json.loads(snapshot_file.readline().decode('utf-8'))
+
+                for column in columns:
+                    column.fromfile(snapshot_file, header['count'])
+
+        except (ValueError, KeyError, EOFError):
+            return False
+
+        finally:
+            os.unlink(path)
+
+        if header['db_mtime'] != os.path.getmtime(db_path):
+            # Database was modified after the snapshot was taken
+            return False
+
+        if last_id > header.get('last_id', -1):
+            # Reminders stored after the window was last updated
+            return False
+
+        if header['horizon'] <= now:
+            return False
+
+        with self._lock:
+            self._epochs, self._ids, self._users = columns
+            self._head = 0
+            self._pending = None
+            self.horizon = header['horizon']
+            self.last_id = header['last_id']
+
+        return True
+
+    def _contains(self, epoch, reminder_id):
+        """Check whether a reminder is in the window. Lock must be held."""
+        start = bisect_left(self._epochs, epoch, self._head)
+        end = bisect_right(self._epochs, epoch, start)
+
+        return reminder_id in self._ids[start:end]
+
+    def _columns(self):
+        """Obtain the arrays of the window. Lock must be held."""
+        return self._epochs, self._ids, self._users
+
+    def _place(self, entries):
+        """Add entries that are not in the window yet. Lock must be held."""
+        entries = sorted(e for e in entries if not self._contains(e[0], e[1]))
+
+        if not entries:
+            return
+
+        head = self._head
+        count = len(entries)
+        columns = (
+            array('d', (e[0] for e in entries)),
+            array('q', (e[1] for e in entries)),
+            array('q', (e[2] for e in entries))
+        )
+
+        if head < len(self._epochs) and entries[-1][0] > self._epochs[head]:
+            self._merge(entries)
+
+        elif head >= count:
+            # Reuse the slots of the entries that were popped
+            for column, values in zip(self._columns(), columns):
+                column[head - count:head] = values
+
+            self._head = head - count
+
+        else:
+            for column, values in zip(self._columns(), columns):
+                column[head:head] = values
+
+    def _merge(self, entries):
+        """Rebuild the arrays merging sorted entries. Lock must be held."""
+        head = self._head
+        current = zip(
+            self._epochs[head:], self._ids[head:], self._users[head:]
+        )
+
+        epochs, ids, users = array('d'), array('q'), array('q')
+
+        for epoch, reminder_id, user_id in merge(
+                current, entries, key=itemgetter(0)):
+            epochs.append(epoch)
+            ids.append(reminder_id)
+            users.append(user_id)
+
+        self._epochs, self._ids, self._users = epochs, ids, users
+        self._head = 0
+
+    def _insert(self, epoch, reminder_id, user_id):
+        """Insert an entry keeping the arrays sorted. Lock must be held."""
+        index = bisect_right(self._epochs, epoch, self._head)
+
+        self._epochs.insert(index, epoch)
+        self._ids.insert(index, reminder_id)
+        self._users.insert(index, user_id)
+
+class RateLimiter(object):
+    """Token bucket limiting the messages sent with a bot token.
+
+    Args:
+        rate (float): Messages allowed per second
+        burst (int): Messages that can be sent at once after being idle.
+            Defaults to the rate
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self._tokens = float(self.burst)
+        self._last = None
+
+    def delay(self, now):
+        """Obtain the seconds to wait before a message can be sent.
+
+        Args:
+            now (float): Current timestamp
+        """
+        self._refill(now)
+
+        if self._tokens >= 1:
+            return 0
+
+        # At least a millisecond, so that waiting always makes progress
+        return max((1 - self._tokens) / self.rate, 0.001)
+
+    def consume(self, now):
+        """Account for a message sent.
+
+        Args:
+            now (float): Current timestamp
+        """
+        self._refill(now)
+        self._tokens -= 1
+
+    def _refill(self, now):
+        """Add the tokens earned since the last call."""
+        if self._last is not None:
+            elapsed = max(now - self._last, 0)
+            self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+
+        self._last = now
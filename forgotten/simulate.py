@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Simulation of the reminder worker in virtual time.
+
+Replays a synthetic workload against the worker and a temporary database,
+using a virtual clock and a fake bot that records deliveries. Example:
+
+    python -m forgotten.simulate --reminders 1000000 --days 7
+"""
+
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+from array import array
+
+from forgotten.clock import VirtualClock
+from forgotten.conf import SETTINGS, get_logger
+
+
+logger = get_logger('simulate')
+
+# Start of the simulated period
+SIM_START = datetime.datetime(2017, 1, 2)
+
+# Number of reminders inserted in each bulk operation
+INSERT_BATCH = 10000
+
+
+class RecordingBot(object):
+    """Fake bot that records sent messages along with the virtual time.
+
+    Messages of all the fake bots are recorded in the same list.
+    """
+
+    def __init__(self, name, clock, sent):
+        self.name = name
+        self.clock = clock
+        self.sent = sent
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((self.clock.time(), chat_id, text))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append((self.clock.time(), chat_id, '_photo'))
+
+def percentile(values, pct):
+    """Obtain a percentile of a sorted sequence (nearest rank)."""
+    if not values:
+        return 0.0
+
+    index = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+def run(reminders=100000, users=1000, bots=1, rate=30, days=7, wait_time=1,
+        window_time=180, burst=0.5, dynamic=0.2, churn=60, seed=0):
+    """Run a simulation.
+
+    Args:
+        reminders (int): Total number of reminders
+        users (int): Number of users at the start
+        bots (int): Number of bots, users are spread among them
+        rate (float): Messages per second allowed for each bot
+        days (int): Number of simulated days
+        wait_time (int): Minutes between checks of the worker
+        window_time (int): Minutes of reminders kept in memory
+        burst (float): Fraction of reminders due at round hours
+        dynamic (float): Fraction of reminders created during the simulation
+            instead of before it
+        churn (int): Minutes between removing a user and adding a new one.
+            A value of 0 disables churn
+        seed (int): Seed for the random generator
+
+    Returns:
+        Dictionary with the results
+    """
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix='forgotten-sim-')
+
+    SETTINGS.update({
+        'bots': {
+            'sim%d' % i: {'token': 'sim%d' % i, 'owner': -1, 'rate': rate}
+            for i in range(bots)
+        },
+        'db_path': os.path.join(workdir, 'forgotten.sqlite'),
+        'media_path': workdir,
+        'wait_time': wait_time * 60,
+        'window_time': window_time * 60,
+        'shutdown_timeout': 0,
+        'snapshot_path': os.path.join(workdir, 'forgotten.snapshot'),
+        'backup_path': workdir,
+        'backup_interval': 0,
+        'backup_media': False,
+        'backup_pages': 64,
+        'backup_sleep': 0,
+        'history_retention': 86400,
+        'history_interval': 3600,
+        'history_batch': 500,
+        'vacuum_pages': 64,
+        'history_sleep': 0.005,
+        'trace': False,
+        'trace_threshold': 1,
+        'trace_profile_dir': '',
+        'trace_profile_rate': 0
+    })
+
+    # The database is opened on import
+    from forgotten import dbops
+    from forgotten.dbops import DB, check_db
+    from forgotten import helper
+
+    try:
+        check_db(DB)
+
+        start = time.mktime(SIM_START.timetuple())
+        end = start + days * 86400
+        clock = VirtualClock(start, end)
+        sent = []
+        senders = {
+            name: RecordingBot(name, clock, sent) for name in SETTINGS['bots']
+        }
+
+        def bot_of(user_id):
+            """Obtain the name of the bot of a user."""
+            return 'sim%d' % (user_id % bots)
+
+        # Users
+        active = list(range(1, users + 1))
+        removed_at = {}
+
+        for user_id in active:
+            dbops.add_user(DB, bot_of(user_id), user_id, 'user%d' % user_id)
+
+        # Reminders, indexed by key. The key is sent as the reminder text
+        dues = array('d')
+        owners = array('q')
+        created = bytearray(reminders)
+        batch = []
+
+        def create(key):
+            """Create a reminder during the simulation, as the bot would."""
+            if owners[key] in removed_at:
+                return
+
+            date = datetime.datetime.fromtimestamp(dues[key])
+            rid = dbops.add_reminder(
+                DB,
+                bot_of(owners[key]),
+                'sim:%d' % key,
+                date,
+                owners[key]
+            )
+            helper.WINDOW.add(dues[key], rid, owners[key])
+            created[key] = 1
+
+        for key in range(reminders):
+            if rng.random() < burst:
+                due = start + rng.randrange(days * 24) * 3600
+            else:
+                due = start + rng.randrange(days * 1440) * 60
+
+            dues.append(due)
+            owners.append(rng.choice(active))
+
+            if rng.random() < dynamic:
+                clock.schedule(rng.uniform(start, due), lambda k=key: create(k))
+                continue
+
+            created[key] = 1
+            batch.append({
+                'bot': bot_of(owners[key]),
+                'text': 'sim:%d' % key,
+                'date': datetime.datetime.fromtimestamp(due),
+                'user_id': owners[key]
+            })
+
+            if len(batch) >= INSERT_BATCH:
+                dbops.add_reminders(DB, batch)
+                batch = []
+
+        if batch:
+            dbops.add_reminders(DB, batch)
+
+        # User churn
+        next_user = [users + 1]
+
+        def rotate_user():
+            """Remove a random user and add a new one."""
+            user_id = active.pop(rng.randrange(len(active)))
+            dbops.remove_user(DB, bot_of(user_id), user_id)
+            removed_at[user_id] = clock.time()
+
+            user_id = next_user[0]
+            active.append(user_id)
+            dbops.add_user(DB, bot_of(user_id), user_id, 'user%d' % user_id)
+            next_user[0] += 1
+
+        if churn > 0:
+            for at in range(int(start), int(end), churn * 60):
+                clock.schedule(at + churn * 60, rotate_user)
+
+        # History pruning and vacuum, as run by the maintenance worker
+        def maintenance():
+            """Run a maintenance pass."""
+            helper.prune_history(clock)
+            helper.vacuum_db(clock)
+
+        interval = SETTINGS['history_interval']
+
+        for at in range(int(start), int(end), interval):
+            clock.schedule(at + interval, maintenance)
+
+        logger.info('starting simulation of %d reminders' % reminders)
+
+        cpu_start = time.process_time()
+        wall_start = time.time()
+
+        helper.forgotten_worker(clock=clock, senders=senders)
+
+        cpu_time = time.process_time() - cpu_start
+        wall_time = time.time() - wall_start
+
+        db_size = os.path.getsize(SETTINGS['db_path'])
+        history = DB.query('SELECT COUNT(*) AS count FROM history').first()
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Results
+    deliveries = bytearray(reminders)
+    lags = array('d')
+    unexpected = 0
+
+    for sent_at, user_id, text in sent:
+        key = int(text.replace('sim:', ''))
+        deliveries[key] = min(deliveries[key] + 1, 255)
+        lags.append(sent_at - dues[key])
+
+        if sent_at > removed_at.get(user_id, end):
+            unexpected += 1
+
+    missed = 0
+    expected = 0
+    limit = end - wait_time * 60
+
+    for key in range(reminders):
+        due = dues[key]
+        cancelled = removed_at.get(owners[key], end + 1)
+
+        if not created[key] or due > limit or cancelled <= due + wait_time * 60:
+            continue
+
+        expected += 1
+
+        if not deliveries[key]:
+            missed += 1
+
+    lags = sorted(lags)
+
+    return {
+        'reminders': reminders,
+        'expected': expected,
+        'delivered': len(sent),
+        'missed': missed,
+        'duplicates': sum(1 for count in deliveries if count > 1),
+        'unexpected': unexpected,
+        'lag_p50': percentile(lags, 50),
+        'lag_p90': percentile(lags, 90),
+        'lag_p99': percentile(lags, 99),
+        'lag_max': lags[-1] if lags else 0.0,
+        'history': history.count,
+        'db_size': db_size,
+        'cpu_per_day': cpu_time / days,
+        'wall_time': wall_time
+    }
+
+def main():
+    """Parse arguments, run the simulation and print the results."""
+    parser = argparse.ArgumentParser(
+        description='Simulate the reminder worker in virtual time'
+    )
+    parser.add_argument('--reminders', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--bots', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=30,
+                        help='messages per second allowed for each bot')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--wait', type=int, default=1,
+                        help='minutes between checks')
+    parser.add_argument('--window', type=int, default=180,
+                        help='minutes of reminders kept in memory')
+    parser.add_argument('--burst', type=float, default=0.5,
+                        help='fraction of reminders due at round hours')
+    parser.add_argument('--dynamic', type=float, default=0.2,
+                        help='fraction of reminders created during the run')
+    parser.add_argument('--churn', type=int, default=60,
+                        help='minutes between user changes (0 to disable)')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    results = run(
+        reminders=args.reminders,
+        users=args.users,
+        bots=args.bots,
+        rate=args.rate,
+        days=args.days,
+        wait_time=args.wait,
+        window_time=args.window,
+        burst=args.burst,
+        dynamic=args.dynamic,
+        churn=args.churn,
+        seed=args.seed
+    )
+
+    print('Reminders:      %d' % results['reminders'])
+    print('Expected:       %d' % results['expected'])
+    print('Delivered:      %d' % results['delivered'])
+    print('Missed:         %d' % results['missed'])
+    print('Duplicates:     %d' % results['duplicates'])
+    print('After removal:  %d' % results['unexpected'])
+    print('Lag p50/p90/p99/max (s): %.1f / %.1f / %.1f / %.1f' % (
+        results['lag_p50'],
+        results['lag_p90'],
+        results['lag_p99'],
+        results['lag_max']
+    ))
+    print('History entries: %d' % results['history'])
+    print('Database size: %.1f KiB' % (results['db_size'] / 1024))
+    print('CPU per simulated day: %.3f s' % results['cpu_per_day'])
+    print('Wall time: %.1f s' % results['wall_time'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Opt-in tracing of update handlers.
+
+When enabled, each update handled by a bot is traced as a tree of spans
+(handler, database operations, lock waits and Bot API requests). Updates that
+take longer than the configured threshold are logged with a breakdown, and a
+sample of them can be profiled with cProfile for offline analysis.
+"""
+
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from forgotten.conf import SETTINGS, get_logger
+
+
+logger = get_logger('trace')
+
+# Trace of the update being handled in each thread
+_local = threading.local()
+
+
+@contextmanager
+def span(name):
+    """Record a span in the trace of the current update.
+
+    Does nothing if the current thread is not handling a traced update.
+
+    Args:
+        name (str): Name of the span
+    """
+    trace = getattr(_local, 'trace', None)
+
+    if trace is None:
+        yield
+        return
+
+    entry = [name, _local.depth, time.perf_counter(), None]
+    trace.append(entry)
+    _local.depth += 1
+
+    try:
+        yield
+
+    finally:
+        _local.depth -= 1
+        entry[3] = time.perf_counter()
+
+def traced(name=None):
+    """Decorator to record calls to the function as spans.
+
+    Args:
+        name (str): Name of the span. Defaults to the function name
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+def trace_update(task, bot_name):
+    """Wrap an update handler so that its execution is traced.
+
+    Args:
+        task (callable): Handler called with the update
+        bot_name (str): Name of the bot handling the update
+
+    Returns:
+        Wrapped handler
+    """
+    func = getattr(task, 'func', task)
+    name = '%s:%s' % (bot_name, getattr(func, '__name__', 'handler'))
+
+    def traced_task(*args, **kwargs):
+        if getattr(_local, 'trace', None) is not None:
+            # Already tracing this update
+            return task(*args, **kwargs)
+
+        profiler = _start_profiler()
+        _local.trace = []
+        _local.depth = 0
+
+        try:
+            with span(name):
+                return task(*args, **kwargs)
+
+        finally:
+            if profiler:
+                profiler.disable()
+
+            trace = _local.trace
+            _local.trace = None
+
+            _report(name, trace, profiler, args)
+
+    return traced_task
+
+def install(bot):
+    """Trace the updates handled by a bot.
+
+    Every handler of the bot, including next step handlers, is dispatched
+    through `_exec_task()`, so it is wrapped there.
+
+    Args:
+        bot: Bot instance
+    """
+    exec_task = bot._exec_task
+
+    def traced_exec_task(task, *args, **kwargs):
+        exec_task(trace_update(task, bot.name), *args, **kwargs)
+
+    bot._exec_task = traced_exec_task
+
+def install_api_hooks():
+    """Record Bot API requests as spans."""
+    from telebot import apihelper
+
+    if getattr(apihelper, '_forgotten_traced', False):
+        return
+
+    make_request = apihelper._make_request
+    download_file = apihelper.download_file
+
+    @wraps(make_request)
+    def traced_make_request(token, method_name, *args, **kwargs):
+        with span('api.%s' % method_name):
+            return make_request(token, method_name, *args, **kwargs)
+
+    apihelper._make_request = traced_make_request
+    apihelper.download_file = traced('api.download_file')(download_file)
+    apihelper._forgotten_traced = True
+
+def _start_profiler():
+    """Start profiling the current update if it is sampled.
+
+    Returns:
+        Profiler, or None if the update is not profiled
+    """
+    if not SETTINGS['trace_profile_dir']:
+        return None
+
+    if random.random() >= SETTINGS['trace_profile_rate']:
+        return None
+
+    profiler = cProfile.Profile()
+
+    try:
+        profiler.enable()
+
+    except ValueError:
+        # Another profiler is active (only one is allowed in recent Pythons)
+        return None
+
+    return profiler
+
+def _report(name, trace, profiler, args):
+    """Log the breakdown of a slow update and store its profile.
+
+    Args:
+        name (str): Name of the root span
+        trace (list): Spans recorded for the update
+        profiler: Profiler used for the update, if any
+        args (tuple): Arguments of the handler
+    """
+    root = trace[0]
+    elapsed = root[3] - root[2]
+
+    if elapsed < SETTINGS['trace_threshold']:
+        return
+
+    lines = ['slow update in %s (%.1f ms)' % (name, elapsed * 1000)]
+
+    message = args[0] if args else None
+    chat = getattr(message, 'chat', None)
+
+    if chat is not None:
+        lines.append(
+            '  chat %s, %s'
+            % (chat.id, getattr(message, 'content_type', 'unknown'))
+        )
+
+    for span_name, depth, start, end in trace:
+        lines.append('  %s%s %.1f ms' % (
+            '  ' * depth,
+            span_name,
+            ((end or start) - start) * 1000
+        ))
+
+    if profiler:
+        path = os.path.join(
+            SETTINGS['trace_profile_dir'],
+            '%s-%s.prof' % (str(time.time()), name.replace(':', '-'))
+        )
+
+        try:
+            os.makedirs(SETTINGS['trace_profile_dir'], exist_ok=True)
+            profiler.dump_stats(path)
+            lines.append('  profile stored in %s' % path)
+
+        except Exception as e:
+            lines.append('  failed to store profile: %s' % e)
+
+    logger.warning('\n'.join(lines))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Test configuration.
+
+`forgotten.dbops` opens its database connector on import, so a temporary
+path must be configured before any test module imports it.
+"""
+
+import os
+import tempfile
+
+import pytest
+from forgotten.conf import SETTINGS, init_db
+
+
+SETTINGS.setdefault(
+    'db_path',
+    os.path.join(tempfile.mkdtemp(prefix='forgotten-tests-'), 'db.sqlite')
+)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Fresh database with the current schema."""
+    from forgotten.dbops import check_db
+
+    database = init_db(str(tmp_path / 'forgotten.sqlite'))
+    check_db(database)
+
+    yield database
+
+    database.close()
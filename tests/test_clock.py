@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the worker clocks."""
+
+import threading
+
+from forgotten.clock import VirtualClock
+
+
+def test_virtual_clock_runs_callbacks_in_order():
+    clock = VirtualClock(0.0, 100.0)
+    calls = []
+
+    clock.schedule(20.0, lambda: calls.append(('b', clock.time())))
+    clock.schedule(10.0, lambda: calls.append(('a', clock.time())))
+    clock.schedule(20.0, lambda: calls.append(('c', clock.time())))
+
+    clock.sleep(15.0)
+    assert calls == [('a', 10.0)]
+    assert clock.time() == 15.0
+
+    clock.sleep(5.0)
+    assert calls == [('a', 10.0), ('b', 20.0), ('c', 20.0)]
+
+def test_virtual_clock_sets_event_at_end():
+    clock = VirtualClock(0.0, 100.0)
+    event = threading.Event()
+
+    assert not clock.wait(event, 60.0)
+    assert clock.time() == 60.0
+
+    assert clock.wait(event, 60.0)
+    assert clock.time() == 100.0
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for configuration parsing."""
+
+import pytest
+from forgotten import conf
+
+
+CONF = """
+[tg.personal]
+token = 123:abc
+owner = 1
+
+[tg.family]
+token = %s
+owner = 2
+
+[core]
+db_path = /tmp/forgotten.sqlite
+media_path = /tmp
+"""
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    """Parse a configuration with the given token for the second bot."""
+    monkeypatch.setattr(conf, 'SETTINGS', {})
+
+    def parse(token):
+        path = tmp_path / 'forgotten.conf'
+        path.write_text(CONF % token)
+        monkeypatch.setenv('FORGOTTEN_CONF', str(path))
+
+        conf.parse_conf()
+
+        return conf.SETTINGS
+
+    return parse
+
+def test_parse_conf_reads_every_bot(settings):
+    bots = settings('456:def')['bots']
+
+    assert sorted(bots) == ['family', 'personal']
+    assert bots['family'] == {'token': '456:def', 'owner': 2, 'rate': 30.0}
+
+def test_parse_conf_rejects_shared_tokens(settings):
+    with pytest.raises(SystemExit):
+        settings('123:abc')
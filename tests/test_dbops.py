@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for database operations."""
+
+import datetime
+import sqlite3
+import threading
+
+import pytest
+from forgotten import dbops
+from forgotten.conf import DEFAULT_BOT, init_db
+
+
+def test_backup_db_copies_concurrent_writes(db, tmp_path):
+    dbops.add_user(db, 'default', 1, 'user')
+    dbops.add_reminders(db, [
+        {'bot': 'default', 'text': 'x' * 1000, 'date': '2017-01-01 10:00',
+         'user_id': 1}
+    ] * 2000)
+
+    stop = threading.Event()
+
+    def writer():
+        while not stop.wait(0.001):
+            dbops.add_reminder(db, 'default', 'new', '2017-01-01 10:00', 1)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+
+    try:
+        dest = str(tmp_path / 'backup.sqlite')
+        dbops.backup_db(db, dest, pages=8, sleep=0.001)
+
+    finally:
+        stop.set()
+        thread.join()
+
+    copy = sqlite3.connect(dest)
+    count = copy.execute('SELECT COUNT(*) FROM reminders').fetchone()[0]
+    copy.close()
+
+    assert count >= 2000
+
+def test_get_upcoming_reminders_pages_by_date_and_id(db):
+    dbops.add_user(db, 'default', 1, 'user')
+    dbops.add_reminders(db, [
+        {'bot': 'default', 'text': 'x', 'date': date, 'user_id': 1}
+        for date in ('2017-01-02 10:00', '2017-01-01 10:00',
+                     '2017-01-01 10:00', '2017-01-03 10:00')
+    ])
+
+    until = datetime.datetime(2017, 1, 3)
+    found = []
+    after = None
+
+    while True:
+        page = dbops.get_upcoming_reminders(db, until, after=after, limit=2)
+        found.extend((r.date, r.id) for r in page)
+
+        if len(page) < 2:
+            break
+
+        after = (page[-1].date, page[-1].id)
+
+    assert found == [
+        ('2017-01-01 10:00', 2), ('2017-01-01 10:00', 3),
+        ('2017-01-02 10:00', 1)
+    ]
+
+def _single_bot_db(path):
+    """Create a database with the schema used before multiple bots."""
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        'CREATE TABLE users (id INTEGER PRIMARY KEY, tg_id INTEGER UNIQUE, '
+        'name TEXT);'
+        'CREATE TABLE reminders (id INTEGER PRIMARY KEY, text TEXT, '
+        'date TEXT, user_id INTEGER, FOREIGN KEY (user_id) '
+        'REFERENCES users (tg_id) ON DELETE CASCADE);'
+        "INSERT INTO users (tg_id, name) VALUES (1, 'user');"
+        "INSERT INTO reminders (text, date, user_id) "
+        "VALUES ('text', '2017-01-01 10:00', 1);"
+    )
+    conn.close()
+
+def test_check_db_migrates_single_bot_database(tmp_path):
+    path = str(tmp_path / 'old.sqlite')
+    _single_bot_db(path)
+
+    db = init_db(path)
+    dbops.check_db(db)
+
+    try:
+        assert dbops.get_users(db, DEFAULT_BOT)[0].name == 'user'
+
+        reminder = dbops.get_reminders(db, [1])[0]
+        assert (reminder.bot, reminder.text) == (DEFAULT_BOT, 'text')
+
+    finally:
+        db.close()
+
+def test_migrate_single_bot_rolls_back_on_failure(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.sqlite')
+    _single_bot_db(path)
+
+    monkeypatch.setattr(
+        dbops, 'MIGRATE_SINGLE_BOT',
+        dbops.MIGRATE_SINGLE_BOT[:-1] + ('DROP TABLE missing',)
+    )
+
+    db = init_db(path)
+
+    try:
+        with pytest.raises(Exception):
+            dbops.migrate_single_bot(db)
+
+    finally:
+        db.close()
+
+    conn = sqlite3.connect(path)
+    tables = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"
+    )]
+    columns = [r[1] for r in conn.execute('PRAGMA table_info(users)')]
+    conn.close()
+
+    assert tables == ['reminders', 'users']
+    assert 'bot' not in columns
+
+def test_incremental_vacuum_reclaims_requested_pages(db):
+    dbops.add_user(db, 'default', 1, 'user')
+    dbops.add_reminders(db, [
+        {'bot': 'default', 'text': 'x' * 1000, 'date': '2017-01-01 10:00',
+         'user_id': 1}
+    ] * 500)
+    dbops.remove_user(db, 'default', 1)
+
+    free_pages = db.query('PRAGMA freelist_count').first().freelist_count
+    assert free_pages > 20
+
+    assert dbops.incremental_vacuum(db, 10) == free_pages - 10
+    assert dbops.incremental_vacuum(db, free_pages) == 0
+
+def test_archive_reminders_is_atomic(db, monkeypatch):
+    dbops.add_user(db, 'default', 1, 'user')
+    reminder_id = dbops.add_reminder(
+        db, 'default', 'text', '2017-01-01 10:00', 1
+    )
+    entry = {
+        'reminder_id': reminder_id, 'bot': 'default', 'user_id': 1,
+        'date': '2017-01-01 10:00', 'delivered_at': '2017-01-01 10:00:05',
+        'outcome': 'sent'
+    }
+
+    monkeypatch.setattr(dbops, 'REMOVE_REMINDERS', 'DELETE FROM missing %s')
+
+    with pytest.raises(Exception):
+        dbops.archive_reminders(db, [entry])
+
+    assert db.query('SELECT COUNT(*) AS count FROM history').first().count == 0
+
+    monkeypatch.undo()
+    dbops.archive_reminders(db, [entry])
+
+    assert dbops.get_reminders(db, [reminder_id]) == []
+    assert db.query('SELECT COUNT(*) AS count FROM history').first().count == 1
+
+def test_get_last_reminder_id(db):
+    assert dbops.get_last_reminder_id(db) == 0
+
+    dbops.add_user(db, 'default', 1, 'user')
+    reminder_id = dbops.add_reminder(
+        db, 'default', 'text', '2017-01-01 10:00', 1
+    )
+
+    assert dbops.get_last_reminder_id(db) == reminder_id
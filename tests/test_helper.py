@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the delivery worker."""
+
+import os
+import sqlite3
+import tarfile
+import threading
+
+import pytest
+from forgotten import dbops, helper
+from forgotten.clock import VirtualClock
+from forgotten.conf import SETTINGS
+from forgotten.schedule import Window, to_epoch
+from forgotten.simulate import RecordingBot
+
+
+START = to_epoch('2017-01-02 10:00')
+
+
+@pytest.fixture
+def worker(db, tmp_path, monkeypatch):
+    """Worker state using the test database and two bots."""
+    monkeypatch.setattr(helper, 'DB', db)
+    monkeypatch.setattr(helper, 'WINDOW', Window())
+    monkeypatch.setattr(helper, 'SHUTDOWN', threading.Event())
+    monkeypatch.setattr(helper, 'LIMITERS', {})
+    monkeypatch.setattr(helper, '_unarchived', [])
+    monkeypatch.setattr(helper, '_deadline', None)
+
+    monkeypatch.setitem(SETTINGS, 'bots', {
+        'a': {'token': 'token-a', 'owner': -1, 'rate': 1},
+        'b': {'token': 'token-b', 'owner': -1, 'rate': 1},
+    })
+    monkeypatch.setitem(SETTINGS, 'db_path', str(tmp_path / 'forgotten.sqlite'))
+    monkeypatch.setitem(SETTINGS, 'snapshot_path', str(tmp_path / 'snapshot'))
+    monkeypatch.setitem(SETTINGS, 'wait_time', 60)
+    monkeypatch.setitem(SETTINGS, 'window_time', 3600)
+
+    dbops.add_user(db, 'a', 1, 'user')
+    dbops.add_user(db, 'b', 2, 'user')
+
+    return db
+
+def _senders(clock, sent):
+    """Recording bots for the configured bots."""
+    return {name: RecordingBot(name, clock, sent) for name in SETTINGS['bots']}
+
+def _count(db, table):
+    return db.query('SELECT COUNT(*) AS count FROM %s' % table).first().count
+
+def test_worker_survives_failed_refill(worker, monkeypatch):
+    dbops.add_reminder(worker, 'a', 'text', '2017-01-02 10:01', 1)
+
+    clock = VirtualClock(START, START + 120)
+    sent = []
+    get_upcoming_reminders = dbops.get_upcoming_reminders
+    calls = []
+
+    def failing_get_upcoming_reminders(*args, **kwargs):
+        calls.append(1)
+
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('disk I/O error')
+
+        return get_upcoming_reminders(*args, **kwargs)
+
+    monkeypatch.setattr(
+        dbops, 'get_upcoming_reminders', failing_get_upcoming_reminders
+    )
+
+    helper.forgotten_worker(clock=clock, senders=_senders(clock, sent))
+
+    assert [text for _, _, text in sent] == ['text']
+    assert helper.WINDOW._pending is None
+
+def test_failed_archive_is_not_sent_again(worker, monkeypatch):
+    dbops.add_reminder(worker, 'a', 'text', '2017-01-02 10:00', 1)
+
+    clock = VirtualClock(START, START + 3600)
+    sent = []
+    senders = _senders(clock, sent)
+    archive_reminders = dbops.archive_reminders
+
+    def full_archive_reminders(db, entries):
+        raise sqlite3.OperationalError('database or disk is full')
+
+    monkeypatch.setattr(dbops, 'archive_reminders', full_archive_reminders)
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, senders)
+
+    assert len(sent) == 1
+    assert _count(worker, 'reminders') == 1
+
+    # Loaded again from the database, but not sent until archived
+    monkeypatch.setattr(dbops, 'archive_reminders', full_archive_reminders)
+    helper.refill_window(START + 60)
+    helper.deliver_reminders(START + 60, clock, senders)
+
+    monkeypatch.setattr(dbops, 'archive_reminders', archive_reminders)
+    helper.refill_window(START + 120)
+    helper.deliver_reminders(START + 120, clock, senders)
+
+    assert len(sent) == 1
+    assert _count(worker, 'reminders') == 0
+    assert _count(worker, 'history') == 1
+
+class ApiError(Exception):
+    """Error raised by the Bot API, with the response that caused it."""
+
+    def __init__(self, status_code):
+        super(ApiError, self).__init__('HTTP %d' % status_code)
+        self.result = type('Response', (object,), {'status_code': status_code})
+
+class FailingBot(RecordingBot):
+    """Bot whose requests fail with the given HTTP status."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def send_message(self, chat_id, text, **kwargs):
+        raise ApiError(self.status_code)
+
+    send_photo = send_message
+
+def test_rejected_reminders_are_archived_as_failed(worker, tmp_path):
+    photo = tmp_path / 'photo'
+    photo.write_bytes(b'photo')
+
+    dbops.add_reminder(worker, 'a', 'text', '2017-01-02 10:00', 1)
+    dbops.add_reminder(worker, 'a', '_photo:%s' % photo, '2017-01-02 10:00', 1)
+
+    clock = VirtualClock(START, START + 3600)
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, {'a': FailingBot(403)})
+
+    outcomes = [r.outcome for r in worker.query('SELECT * FROM history')]
+
+    assert outcomes == ['failed', 'failed']
+    assert _count(worker, 'reminders') == 0
+    assert not photo.exists()
+
+@pytest.mark.parametrize('status_code', [429, 502])
+def test_temporary_errors_are_retried(worker, status_code):
+    dbops.add_reminder(worker, 'a', 'text', '2017-01-02 10:00', 1)
+
+    clock = VirtualClock(START, START + 3600)
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, {'a': FailingBot(status_code)})
+
+    assert _count(worker, 'history') == 0
+
+    sent = []
+    helper.refill_window(START + 60)
+    helper.deliver_reminders(START + 60, clock, _senders(clock, sent))
+
+    assert [text for _, _, text in sent] == ['text']
+
+class ReplyingBot(object):
+    """Bot that records its replies."""
+
+    def __init__(self, name, owner):
+        self.name = name
+        self.owner = owner
+        self.replies = []
+
+    def reply_to(self, message, text):
+        self.replies.append(text)
+
+def _message(chat_id):
+    chat = type('Chat', (object,), {'id': chat_id})
+    return type('Message', (object,), {'chat': chat, 'text': '/stats'})
+
+def test_admin_commands_reject_owners_of_other_bots(monkeypatch):
+    monkeypatch.setitem(SETTINGS, 'admin', 1)
+    calls = []
+
+    @helper.needs_admin
+    def handle_stats(bot, message):
+        calls.append(bot.name)
+
+    handle_stats(ReplyingBot('tenant', 2), _message(2))
+    handle_stats(ReplyingBot('tenant', 2), _message(1))
+
+    assert calls == ['tenant']
+
+def test_rate_limits_apply_per_token(worker, monkeypatch):
+    monkeypatch.setitem(SETTINGS['bots'], 'c', {
+        'token': 'token-a', 'owner': -1, 'rate': 1
+    })
+
+    assert helper._get_limiter('a') is helper._get_limiter('c')
+    assert helper._get_limiter('a') is not helper._get_limiter('b')
+
+def test_prune_history_pauses_between_batches(worker, monkeypatch):
+    monkeypatch.setitem(SETTINGS, 'history_retention', 86400)
+    monkeypatch.setitem(SETTINGS, 'history_batch', 2)
+    monkeypatch.setitem(SETTINGS, 'history_sleep', 0.005)
+
+    for _ in range(5):
+        reminder_id = dbops.add_reminder(
+            worker, 'a', 'text', '2017-01-01 10:00', 1
+        )
+        dbops.archive_reminders(worker, [{
+            'reminder_id': reminder_id, 'bot': 'a', 'user_id': 1,
+            'date': '2016-12-01 10:00', 'delivered_at': '2016-12-01 10:00:00',
+            'outcome': 'sent'
+        }])
+
+    clock = VirtualClock(START, START + 3600)
+
+    assert helper.prune_history(clock) == 5
+    assert _count(worker, 'history') == 0
+
+    # Two full batches, each followed by a pause
+    assert clock.time() == pytest.approx(START + 0.01)
+
+def test_deliver_interleaves_bots_within_rate(worker):
+    for text in ('a1', 'a2', 'a3'):
+        dbops.add_reminder(worker, 'a', text, '2017-01-02 10:00', 1)
+
+    dbops.add_reminder(worker, 'b', 'b1', '2017-01-02 10:00', 2)
+
+    clock = VirtualClock(START, START + 3600)
+    sent = []
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, _senders(clock, sent))
+
+    # One message per second for each bot, without waiting for the other
+    assert sent == [
+        (START, 1, 'a1'),
+        (START, 2, 'b1'),
+        (START + 1, 1, 'a2'),
+        (START + 2, 1, 'a3'),
+    ]
+
+def test_deliver_returns_pending_entries_at_deadline(worker, monkeypatch):
+    for text in ('a1', 'a2', 'a3', 'a4'):
+        dbops.add_reminder(worker, 'a', text, '2017-01-02 10:00', 1)
+
+    monkeypatch.setattr(helper, '_deadline', START + 1.5)
+
+    clock = VirtualClock(START, START + 3600)
+    sent = []
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, _senders(clock, sent))
+
+    assert [text for _, _, text in sent] == ['a1', 'a2']
+    assert [e[1] for e in helper.WINDOW.pop_due(START)] == [3, 4]
+    assert _count(worker, 'reminders') == 2
+
+def test_deliver_moves_reminders_to_history(worker, tmp_path):
+    dbops.add_reminder(worker, 'a', 'text', '2017-01-02 10:00', 1)
+    dbops.add_reminder(
+        worker, 'b', '_photo:%s' % (tmp_path / 'missing'),
+        '2017-01-02 10:00', 2
+    )
+
+    clock = VirtualClock(START, START + 3600)
+    sent = []
+    helper.refill_window(START)
+    helper.deliver_reminders(START, clock, _senders(clock, sent))
+
+    history = [
+        (r.reminder_id, r.bot, r.user_id, r.date, r.delivered_at, r.outcome)
+        for r in worker.query('SELECT * FROM history ORDER BY reminder_id')
+    ]
+
+    assert history == [
+        (1, 'a', 1, '2017-01-02 10:00', '2017-01-02 10:00:00', 'sent'),
+        (2, 'b', 2, '2017-01-02 10:00', '2017-01-02 10:00:00',
+         'missing_photo'),
+    ]
+    assert _count(worker, 'reminders') == 0
+
+def test_make_backup_bundles_referenced_photos(worker, tmp_path, monkeypatch):
+    backup_dir = tmp_path / 'backups'
+    monkeypatch.setitem(SETTINGS, 'backup_path', str(backup_dir))
+    monkeypatch.setitem(SETTINGS, 'backup_pages', 8)
+    monkeypatch.setitem(SETTINGS, 'backup_sleep', 0)
+
+    photo = tmp_path / 'photo'
+    photo.write_bytes(b'photo')
+
+    dbops.add_reminder(worker, 'a', '_photo:%s' % photo, '2017-01-02 10:00', 1)
+    dbops.add_reminder(
+        worker, 'a', '_photo:%s' % (tmp_path / 'missing'),
+        '2017-01-02 10:00', 1
+    )
+
+    path = helper.make_backup(with_media=True)
+
+    with tarfile.open(path) as tar:
+        names = sorted(tar.getnames())
+        database = tar.extractfile(names[0]).read()
+
+    assert names[0].endswith('.sqlite')
+    assert names[1:] == ['media/photo']
+    assert database.startswith(b'SQLite format 3')
+
+    # Only the tarball is kept
+    assert os.listdir(str(backup_dir)) == [os.path.basename(path)]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the scheduling window."""
+
+import os
+
+from forgotten.schedule import RateLimiter, Window
+
+
+def test_load_ignores_entries_added_during_load():
+    window = Window()
+
+    # Reminder committed after start_load() but before the query
+    window.start_load()
+    window.add(100.0, 1, 10)
+    window.load([(100.0, 1, 10), (200.0, 2, 10)], 1000.0)
+
+    assert window.pop_due(1000.0) == [(100.0, 1, 10), (200.0, 2, 10)]
+
+def test_add_ignores_reminders_already_loaded():
+    window = Window()
+
+    # Refill completed between storing the reminder and adding it
+    window.load([(100.0, 1, 10)], 1000.0)
+    window.add(100.0, 1, 10)
+    window.add(100.0, 2, 10)
+
+    assert window.pop_due(1000.0) == [(100.0, 1, 10), (100.0, 2, 10)]
+
+def test_push_back_restores_entries_in_order():
+    window = Window()
+    window.load([(float(i), i, 10) for i in range(10)], 1000.0)
+
+    due = window.pop_due(5.0)
+    window.push_back(due[3:])
+
+    # Some were loaded again by a refill while being delivered
+    window.add(7.5, 20, 10)
+    window.push_back(due[:3] + [(8.0, 8, 10), (9.5, 21, 10)])
+
+    assert [e[1] for e in window.pop_due(1000.0)] == (
+        list(range(8)) + [20, 8, 9, 21]
+    )
+
+def test_load_merges_entries_added_during_load():
+    window = Window()
+    window.load([(300.0, 3, 10)], 1000.0)
+    window.pop_due(300.0)
+
+    window.start_load()
+    window.add(150.0, 5, 10)
+    window.add(2000.0, 6, 10)
+    window.load(iter([(100.0, 1, 10), (200.0, 2, 10), (300.0, 3, 10)]), 1000.0)
+
+    assert [e[1] for e in window.pop_due(1000.0)] == [1, 5, 2, 3]
+
+def test_load_sorts_unordered_entries():
+    window = Window()
+    window.load([(200.0, 2, 10), (100.0, 1, 10)], 1000.0)
+
+    assert [e[1] for e in window.pop_due(1000.0)] == [1, 2]
+
+def test_pop_due_compacts_sent_entries():
+    window = Window()
+    window.load([(float(i), i, 10) for i in range(10)], 1000.0)
+
+    assert [e[1] for e in window.pop_due(2.0)] == [0, 1, 2]
+    assert len(window) == 7
+
+    window.pop_due(6.0)
+    assert len(window._epochs) == 3
+    assert window.stats()['entries'] == 3
+
+    window.add(2.5, 20, 10)
+    window.add(5000.0, 21, 10)
+    assert [e[1] for e in window.pop_due(1000.0)] == [20, 7, 8, 9]
+
+def test_snapshot_round_trip(tmp_path):
+    db_path = str(tmp_path / 'db.sqlite')
+    path = str(tmp_path / 'window.snapshot')
+    open(db_path, 'w').close()
+
+    window = Window()
+    window.load([(100.0, 1, 10), (200.0, 2, 11), (300.0, 3, 12)], 1000.0, 5)
+    window.pop_due(100.0)
+    window.save_snapshot(path, db_path)
+
+    resumed = Window()
+    assert resumed.load_snapshot(path, db_path, 150.0, 5)
+    assert resumed.horizon == 1000.0
+    assert resumed.pop_due(1000.0) == [(200.0, 2, 11), (300.0, 3, 12)]
+
+    # Snapshots are only used once
+    assert not resumed.load_snapshot(path, db_path, 150.0, 5)
+
+def test_snapshot_discarded_after_database_changes(tmp_path):
+    db_path = str(tmp_path / 'db.sqlite')
+    path = str(tmp_path / 'window.snapshot')
+    open(db_path, 'w').close()
+
+    window = Window()
+    window.load([(100.0, 1, 10)], 1000.0, 1)
+    window.save_snapshot(path, db_path)
+
+    mtime = os.path.getmtime(db_path)
+    os.utime(db_path, (mtime + 10, mtime + 10))
+
+    assert not Window().load_snapshot(path, db_path, 50.0, 1)
+    assert not os.path.exists(path)
+
+def test_snapshot_discarded_after_reminder_missed_window(tmp_path):
+    db_path = str(tmp_path / 'db.sqlite')
+    path = str(tmp_path / 'window.snapshot')
+    open(db_path, 'w').close()
+
+    window = Window()
+    window.load([(100.0, 1, 10)], 1000.0, 1)
+    window.add(5000.0, 2, 10)
+
+    # Reminder 3 stored before the snapshot, but added to the window after it
+    window.save_snapshot(path, db_path)
+    window.add(200.0, 3, 10)
+
+    assert not Window().load_snapshot(path, db_path, 50.0, 3)
+
+def test_rate_limiter_allows_burst_then_rate():
+    limiter = RateLimiter(2, burst=3)
+
+    for _ in range(3):
+        assert limiter.delay(0.0) == 0
+        limiter.consume(0.0)
+
+    assert limiter.delay(0.0) == 0.5
+    assert limiter.delay(0.5) == 0
+
+    # Idle time does not earn more than the burst
+    assert limiter.delay(100.0) == 0
+    assert limiter._tokens == 3
+
+def test_rate_limiter_delay_always_progresses():
+    limiter = RateLimiter(30)
+    now = 1.5e9
+
+    for _ in range(100):
+        while limiter.delay(now):
+            now += limiter.delay(now)
+
+        limiter.consume(now)
+
+    assert now > 1.5e9 + 2
+
+def test_abort_load_keeps_window_and_new_entries():
+    window = Window()
+    window.load([(100.0, 1, 10)], 1000.0)
+
+    window.start_load()
+    window.add(50.0, 2, 10)
+    window.add(2000.0, 3, 10)
+    window.abort_load()
+
+    window.add(60.0, 4, 10)
+
+    assert [e[1] for e in window.pop_due(1000.0)] == [2, 4, 1]
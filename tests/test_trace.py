@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# forgotten
+# https://github.com/rmed/forgotten
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the tracing of updates."""
+
+import pytest
+from forgotten import dbops, trace
+from forgotten.conf import SETTINGS
+
+
+@pytest.fixture
+def reports(monkeypatch):
+    """Traces reported by updates, as (name, spans) tuples."""
+    monkeypatch.setitem(SETTINGS, 'trace_threshold', 0)
+    monkeypatch.setitem(SETTINGS, 'trace_profile_dir', '')
+    monkeypatch.setitem(SETTINGS, 'trace_profile_rate', 0)
+
+    reported = []
+    report = trace._report
+
+    def recording_report(name, spans, profiler, args):
+        reported.append((name, [(s[0], s[1]) for s in spans]))
+        report(name, spans, profiler, args)
+
+    monkeypatch.setattr(trace, '_report', recording_report)
+
+    return reported
+
+def _locked_operation(traced, monkeypatch):
+    monkeypatch.setitem(SETTINGS, 'trace', traced)
+
+    def get_nothing(db):
+        return db
+
+    return dbops.locked(get_nothing)
+
+def test_locked_records_spans_when_tracing(reports, monkeypatch):
+    get_nothing = _locked_operation(True, monkeypatch)
+    trace.trace_update(lambda: get_nothing(None), 'bot')()
+
+    assert reports[0][1][1:] == [('dbops.get_nothing', 1), ('lock wait', 2)]
+
+def test_locked_without_tracing_only_takes_lock(reports, monkeypatch):
+    get_nothing = _locked_operation(False, monkeypatch)
+    trace.trace_update(lambda: get_nothing(None), 'bot')()
+
+    assert len(reports[0][1]) == 1
+    assert not dbops._LOCK.locked()
+
+def test_spans_are_nested(reports):
+    @trace.traced()
+    def query():
+        with trace.span('lock wait'):
+            pass
+
+    def handle_remember(message):
+        query()
+
+        with trace.span('api.sendMessage'):
+            pass
+
+    trace.trace_update(handle_remember, 'bot')(None)
+
+    assert reports == [('bot:handle_remember', [
+        ('bot:handle_remember', 0),
+        ('query', 1),
+        ('lock wait', 2),
+        ('api.sendMessage', 1),
+    ])]
+
+def test_spans_outside_updates_are_ignored():
+    with trace.span('ignored'):
+        pass
+
+    assert getattr(trace._local, 'trace', None) is None
+
+def test_only_slow_updates_are_logged(reports, monkeypatch, caplog):
+    monkeypatch.setitem(SETTINGS, 'trace_threshold', 60)
+    trace.trace_update(lambda: None, 'bot')()
+
+    assert len(reports) == 1
+    assert 'slow update' not in caplog.text
+
+    monkeypatch.setitem(SETTINGS, 'trace_threshold', 0)
+    trace.trace_update(lambda: None, 'bot')()
+
+    assert 'slow update in bot:<lambda>' in caplog.text
+
+def test_nested_updates_are_traced_once(reports):
+    def next_step():
+        pass
+
+    def handle_start():
+        trace.trace_update(next_step, 'bot')()
+
+    trace.trace_update(handle_start, 'bot')()
+
+    assert [name for name, _ in reports] == ['bot:handle_start']
+
+def test_profiles_are_stored(reports, monkeypatch, tmp_path):
+    profile_dir = tmp_path / 'profiles'
+    monkeypatch.setitem(SETTINGS, 'trace_profile_dir', str(profile_dir))
+    monkeypatch.setitem(SETTINGS, 'trace_profile_rate', 1)
+
+    trace.trace_update(lambda: sum(range(1000)), 'bot')()
+
+    profiles = list(profile_dir.iterdir())
+
+    assert len(profiles) == 1
+    assert profiles[0].name.endswith('bot-<lambda>.prof')
+
+class FakeBot(object):
+    """Bot that runs its tasks in the calling thread."""
+
+    name = 'bot'
+
+    def _exec_task(self, task, *args, **kwargs):
+        task(*args, **kwargs)
+
+def test_install_traces_bot_tasks(reports):
+    bot = FakeBot()
+    trace.install(bot)
+
+    def handle_stats(message):
+        pass
+
+    bot._exec_task(handle_stats, None)
+
+    assert [name for name, _ in reports] == ['bot:handle_stats']